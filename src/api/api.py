@@ -1,8 +1,42 @@
+import asyncio
 import json
 import logging
-from fastapi import FastAPI, HTTPException
-from dsba.model_registry import list_models_ids, load_model, load_model_metadata
-from dsba.model_prediction import classify_record
+import os
+import uuid
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from typing import Annotated
+from urllib.parse import parse_qs
+import pandas as pd
+import pyarrow as pa
+from fastapi import FastAPI, HTTPException, Query, Request
+from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, Response
+from dsba.batch_jobs import JobRunner, get_job_store, get_jobs_dir
+from dsba.arrow_format import (
+    ARROW_STREAM_MEDIA_TYPE,
+    PARQUET_MEDIA_TYPE,
+    read_dataframe_from_bytes,
+    write_table_to_bytes,
+)
+from dsba.metrics import REGISTRY, StageTimer
+from dsba.profiling import get_profiler
+from dsba.model_registry import list_models_ids
+from dsba.model_serving import ServedModel, get_model_serving_cache
+from dsba.monitoring import FeatureMonitor, get_feature_monitor
+from dsba.model_prediction import (
+    classify_dataframe,
+    classify_dataframe_multi,
+    classify_records,
+)
+from dsba.prediction_cache import (
+    PredictionCacheStats,
+    classify_records_cached,
+    get_prediction_cache,
+)
+from dsba.shadow_scoring import get_shadow_scorer
+from dsba.worker_state import StatePublisher, read_other_workers_states
 
 
 logging.basicConfig(
@@ -11,7 +45,99 @@ logging.basicConfig(
     datefmt="%H:%M:%S,",
 )
 
-app = FastAPI()
+
+
+# The "lifespan" runs code when the server starts (before the yield) and when it stops
+# (after).
+# Models are kept in memory between requests, and a background thread swaps in new
+# versions when they are published.
+# Batch scoring jobs are processed by background worker threads (DSBA_JOB_WORKERS,
+# 0 to disable them in this process).
+# With several worker processes, each one publishes its metrics, cache and monitoring
+# state (see dsba.worker_state).
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    get_model_serving_cache().start_background_reload()
+    state_publisher = StatePublisher()
+    state_publisher.start()
+    job_workers = int(os.getenv("DSBA_JOB_WORKERS", "2"))
+    job_runner = None
+    if job_workers:
+        job_runner = JobRunner(get_job_store(), workers=job_workers)
+        job_runner.start()
+    yield
+    state_publisher.stop()
+    if job_runner is not None:
+        job_runner.stop()
+    get_model_serving_cache().stop_background_reload()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Metrics are declared once when the module is imported, and updated by each request.
+# They are exposed on the "/metrics" route for Prometheus (or a simple curl) to read.
+PREDICT_STAGE_SECONDS = REGISTRY.histogram(
+    "dsba_predict_stage_seconds",
+    "Duration of each stage of a prediction request",
+    ("model_id", "stage", "outcome"),
+)
+PREDICT_REQUEST_SECONDS = REGISTRY.histogram(
+    "dsba_predict_request_seconds",
+    "Total duration of prediction requests",
+    ("model_id", "outcome"),
+)
+PREDICT_REQUESTS_TOTAL = REGISTRY.counter(
+    "dsba_predict_requests_total",
+    "Number of prediction requests",
+    ("model_id", "outcome"),
+)
+
+# Threads used to load and run several models concurrently for a single request
+MODELS_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="models")
+
+
+class ProfileRequestsMiddleware:
+    """
+    Profiles the requests that ask for it with the header
+    "X-DSBA-Profile: 1" or the query parameter "profile=1".
+    Profiles are written in DSBA_PROFILE_DIR, and rate limited so
+    that it is safe to keep this available in production.
+
+    It is a plain ASGI middleware (a function of the raw request)
+    instead of @app.middleware("http"):
+    requests that don't ask for a profile are passed to the app
+    right away, without any extra work.
+
+    Note: cProfile and the stack sampler look at the thread running the
+    event loop. While a profiled request waits (for its body, a thread
+    pool...), other requests handled by the same worker run on that thread
+    too, and their work shows up in the profile. For a clean profile of a
+    single request, profile when the worker is idle.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not _is_profiling_requested(scope):
+            await self.app(scope, receive, send)
+            return
+        with get_profiler().profile(f"api{scope['path']}") as profile_result:
+
+            async def send_with_profile_id(message):
+                if message["type"] == "http.response.start" and profile_result:
+                    profile_id = profile_result.pstats_path.stem.encode()
+                    headers = [
+                        *message.get("headers", []),
+                        (b"x-dsba-profile-id", profile_id),
+                    ]
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_profile_id)
+
+
+app.add_middleware(ProfileRequestsMiddleware)
 
 
 # using FastAPI with defaults is very convenient
@@ -22,6 +148,16 @@ async def list_models():
     return list_models_ids()
 
 
+@app.get("/metrics")
+async def metrics():
+    # The metrics of all the worker processes of the API, not only the one answering
+    other_metrics = [state["metrics"] for state in read_other_workers_states()]
+    return PlainTextResponse(
+        REGISTRY.render(other_metrics),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
 @app.api_route("/predict/", methods=["GET", "POST"])
 async def predict(query: str, model_id: str):
     """
@@ -29,17 +165,365 @@ async def predict(query: str, model_id: str):
     The query should be a json string representing a record.
     """
     # This function is a bit naive and focuses on the logic.
-    # To make it more production-ready you would want to validate the input, manage authentication,
-    # process the various possible errors and raise an appropriate HTTP exception, etc.
+    # To make it more production-ready you would want to validate the input,
+    # manage authentication, etc.
+    timer = StageTimer()
+    outcome = "ok"
+    served_model = None
     try:
-        record = json.loads(query)
-        model = load_model(model_id)
-        metadata = load_model_metadata(model_id)
-        prediction = classify_record(model, record, metadata.target_column)
+        with timer.time("parse_json"):
+            record = json.loads(query)
+        with timer.time("get_model"):
+            served_model = get_model_serving_cache().get(model_id)
+        # _classify adds the "preprocess" and "predict" stages to the timer
+        prediction = _classify(served_model, [record], timer)[0]
         return {"prediction": prediction}
     except Exception as e:
         # We do want users to be able to see the exception message in the response
         # FastAPI will by default block the Exception and send a 500 status code
         # (In the HTTP protocol, a 500 status code just means "Internal Server Error" aka "Something went wrong but we're not going to tell you what")
         # So we raise an HTTPException that contains the same details as the original Exception and FastAPI will send to the client.
-        raise HTTPException(status_code=500, detail=str(e))
+        # Its status code tells the client whether the problem comes from its request
+        # or from our side.
+        status_code, outcome = _status_for_exception(e)
+        raise HTTPException(status_code=status_code, detail=str(e)) from e
+    finally:
+        _record_request_metrics(timer, served_model, outcome)
+
+
+@app.post("/predict/batch/")
+async def predict_batch(records: list[dict], model_id: str):
+    """
+    Predict the target column of several records at once using a model.
+    The body of the request should be a json list of records.
+    """
+    timer = StageTimer()
+    outcome = "ok"
+    served_model = None
+    try:
+        with timer.time("get_model"):
+            served_model = get_model_serving_cache().get(model_id)
+        predictions = _classify(served_model, records, timer)
+        return {"predictions": predictions}
+    except Exception as e:
+        status_code, outcome = _status_for_exception(e)
+        raise HTTPException(status_code=status_code, detail=str(e)) from e
+    finally:
+        _record_request_metrics(timer, served_model, outcome)
+
+
+@app.post("/predict/arrow/")
+async def predict_arrow(request: Request, model_id: str):
+    """
+    Predict the target column of many records sent in a binary columnar format.
+    The body should be an Arrow IPC stream
+    (Content-Type: application/vnd.apache.arrow.stream)
+    or a Parquet file (Content-Type: application/vnd.apache.parquet).
+    The predictions are returned as a single column table named after the target
+    column, in the format given by the Accept header (or the same format as the
+    request by default).
+    """
+    timer = StageTimer()
+    outcome = "ok"
+    served_model = None
+    try:
+        request_media_type = request.headers.get("content-type", "").split(";")[0]
+        response_media_type = request.headers.get("accept", "").split(";")[0]
+        if response_media_type not in (ARROW_STREAM_MEDIA_TYPE, PARQUET_MEDIA_TYPE):
+            response_media_type = request_media_type
+        with timer.time("read_body"):
+            body = await request.body()
+        # Bodies are large here: parsing, loading the model, scoring and serializing
+        # are done in threads so that the event loop keeps serving other requests
+        loop = asyncio.get_running_loop()
+        with timer.time("parse_arrow"):
+            df = await loop.run_in_executor(
+                None, read_dataframe_from_bytes, body, request_media_type
+            )
+        with timer.time("get_model"):
+            served_model = await loop.run_in_executor(
+                MODELS_EXECUTOR, get_model_serving_cache().get, model_id
+            )
+        target_column = served_model.metadata.target_column
+        df = await loop.run_in_executor(
+            None,
+            classify_dataframe,
+            served_model.model,
+            df,
+            target_column,
+            _get_monitor(served_model),
+            timer,
+            served_model.metadata.categories,
+        )
+        with timer.time("serialize_arrow"):
+            predictions = pa.table({target_column: pa.array(df[target_column])})
+            content = await loop.run_in_executor(
+                None, write_table_to_bytes, predictions, response_media_type
+            )
+        return Response(content=content, media_type=response_media_type)
+    except Exception as e:
+        status_code, outcome = _status_for_exception(e)
+        raise HTTPException(status_code=status_code, detail=str(e)) from e
+    finally:
+        _record_request_metrics(timer, served_model, outcome)
+
+
+@app.post("/predict/multi/")
+async def predict_multi(
+    records: list[dict],
+    model_ids: Annotated[list[str], Query()],
+    shadow_model_ids: Annotated[list[str] | None, Query()] = None,
+):
+    """
+    Predict the target column of records with several models at once,
+    e.g. /predict/multi/?model_ids=model_a&model_ids=model_b
+    The records are preprocessed once (per distinct categories of
+    the models) and the models run concurrently.
+    Shadow models (shadow_model_ids) score the records in the background,
+    their predictions are logged and compared with the first model of model_ids,
+    but not returned.
+    """
+    timer = StageTimer()
+    outcome = "ok"
+    primary_model_id = model_ids[0]
+    primary_served_model = None
+    try:
+        # Loading and running the models blocks, it is done in threads so that the
+        # event loop keeps serving other requests meanwhile
+        loop = asyncio.get_running_loop()
+        serving_cache = get_model_serving_cache()
+        with timer.time("get_model"):
+            served_models = await asyncio.gather(
+                *(
+                    loop.run_in_executor(MODELS_EXECUTOR, serving_cache.get, model_id)
+                    for model_id in model_ids
+                )
+            )
+        primary_served_model = served_models[0]
+        df = pd.DataFrame(records)
+        monitor = _get_monitor(primary_served_model)
+        if monitor is not None:
+            monitor.observe(df)
+        # Preprocessing modifies the DataFrame, the shadow models get their own copy
+        shadow_df = df.copy() if shadow_model_ids else None
+        # Not in MODELS_EXECUTOR: this call waits for the models it runs there,
+        # it would deadlock if it took the threads they need
+        predictions = await loop.run_in_executor(
+            None,
+            classify_dataframe_multi,
+            {m.model_id: m.model for m in served_models},
+            df,
+            [m.metadata.target_column for m in served_models],
+            MODELS_EXECUTOR,
+            {m.model_id: m.metadata.categories for m in served_models},
+            timer,
+        )
+        get_shadow_scorer().submit(
+            serving_cache.get,
+            shadow_model_ids or [],
+            shadow_df,
+            primary_model_id,
+            predictions[primary_model_id],
+        )
+        return {"predictions": predictions}
+    except Exception as e:
+        status_code, outcome = _status_for_exception(e)
+        raise HTTPException(status_code=status_code, detail=str(e)) from e
+    finally:
+        _record_request_metrics(timer, primary_served_model, outcome)
+
+
+class ScoringJobRequest(BaseModel):
+    model_id: str
+    input_path: str
+    output_dir: str
+    chunk_size: int = 100_000
+
+
+@app.post("/jobs/")
+async def submit_job(job_request: ScoringJobRequest):
+    """
+    Submit a job to score a CSV file in the background.
+    The paths are on the machine running the API, relative to its jobs
+    directory (DSBA_JOBS_PATH): paths outside of it are refused.
+    The output directory receives one CSV file per chunk.
+    """
+    store = get_job_store()
+    try:
+        if not store.resolve_path(job_request.input_path).exists():
+            raise FileNotFoundError(f"No file at {job_request.input_path}")
+        job = store.create(**job_request.model_dump())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    return _job_as_dict(job)
+
+
+@app.post("/jobs/upload/")
+async def submit_job_upload(
+    request: Request, model_id: str, output_dir: str, chunk_size: int = 100_000
+):
+    """
+    Submit a job to score a CSV file sent as the body of the request.
+    The body is streamed to disk, so the file does not need to fit in memory.
+    output_dir is relative to the jobs directory, as for /jobs/.
+    """
+    store = get_job_store()
+    try:
+        store.resolve_path(output_dir)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e)) from e
+    uploads_dir = get_jobs_dir() / "uploads"
+    uploads_dir.mkdir(exist_ok=True)
+    input_path = uploads_dir / f"{uuid.uuid4().hex}.csv"
+    with open(input_path, "wb") as f:
+        async for block in request.stream():
+            f.write(block)
+    try:
+        job = store.create(model_id, str(input_path), output_dir, chunk_size)
+    except FileNotFoundError as e:
+        input_path.unlink()
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    return _job_as_dict(job)
+
+
+@app.get("/jobs/")
+async def list_jobs():
+    return [_job_as_dict(job) for job in get_job_store().list_jobs()]
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = get_job_store().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job with id {job_id}")
+    return _job_as_dict(job)
+
+
+def _job_as_dict(job) -> dict:
+    return {**asdict(job), "progress": job.progress}
+
+
+@app.get("/predict/cache/")
+async def prediction_cache_stats():
+    cache = get_prediction_cache()
+    if cache is None:
+        return {"enabled": False}
+    # Each worker process has its own cache, the stats are the totals of all of them
+    all_stats = [cache.stats()] + [
+        PredictionCacheStats(**state["prediction_cache"])
+        for state in read_other_workers_states()
+        if state["prediction_cache"] is not None
+    ]
+    stats = PredictionCacheStats(
+        **{
+            field: sum(getattr(s, field) for s in all_stats)
+            for field in ("hits", "misses", "evictions", "size")
+        }
+    )
+    return {
+        "enabled": True,
+        "hit_ratio": stats.hit_ratio,
+        "workers": len(all_stats),
+        **asdict(stats),
+    }
+
+
+@app.get("/monitoring/{model_id}")
+async def monitoring_report(model_id: str):
+    """
+    Drift report of the features seen by the active version of a model,
+    compared to its training data
+    """
+    try:
+        served_model = get_model_serving_cache().get(model_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e)) from e
+    monitor = _get_monitor(served_model)
+    if monitor is None:
+        return {"enabled": False}
+    # Each worker monitors the requests it answers, the report covers all the workers
+    other_states = [
+        state["monitors"][model_id]["sketches"]
+        for state in read_other_workers_states()
+        if state["monitors"].get(model_id, {}).get("version") == served_model.version
+    ]
+    return {
+        "enabled": True,
+        "version": served_model.version,
+        "features": monitor.drift_report(other_states),
+    }
+
+
+def _classify(
+    served_model: ServedModel, records: list[dict], timer: StageTimer
+) -> list:
+    model = served_model.model
+    target_column = served_model.metadata.target_column
+    categories = served_model.metadata.categories
+    monitor = _get_monitor(served_model)
+    # The prediction cache is optional, it is enabled with the
+    # environment variable DSBA_PREDICTION_CACHE_SIZE.
+    # Models saved without their categories encode categories per
+    # request: the prediction of a record depends on the other
+    # records of the request, so it can't be cached record by record.
+    cache = get_prediction_cache()
+    if cache is None or categories is None:
+        return classify_records(
+            model, records, target_column, monitor, timer, categories
+        )
+    return classify_records_cached(
+        cache,
+        model,
+        served_model.model_id,
+        served_model.version,
+        records,
+        target_column,
+        monitor,
+        timer,
+        categories,
+    )
+
+
+def _get_monitor(served_model: ServedModel) -> FeatureMonitor | None:
+    return get_feature_monitor(
+        served_model.model_id,
+        served_model.version,
+        served_model.metadata.feature_baseline,
+    )
+
+
+def _record_request_metrics(
+    timer: StageTimer, served_model: ServedModel | None, outcome: str
+) -> None:
+    # The model id comes from the client: until it was resolved to a model, any value
+    # would create new metric series
+    metric_model_id = "unknown" if served_model is None else served_model.model_id
+    timer.record(
+        PREDICT_STAGE_SECONDS,
+        PREDICT_REQUEST_SECONDS,
+        model_id=metric_model_id,
+        outcome=outcome,
+    )
+    PREDICT_REQUESTS_TOTAL.inc(model_id=metric_model_id, outcome=outcome)
+
+
+def _is_profiling_requested(scope: dict) -> bool:
+    flag = dict(scope["headers"]).get(b"x-dsba-profile", b"").decode()
+    if not flag and b"profile=" in scope["query_string"]:
+        flag = parse_qs(scope["query_string"].decode()).get("profile", [""])[0]
+    return flag.lower() in ("1", "true", "yes")
+
+
+def _status_for_exception(e: Exception) -> tuple[int, str]:
+    """Maps a prediction error to an HTTP status code and a metrics outcome label"""
+    if isinstance(e, json.JSONDecodeError):
+        return 400, "bad_request"
+    if isinstance(e, FileNotFoundError):
+        # The registry raises this when there is no model (or version) for the given id
+        return 404, "not_found"
+    if isinstance(e, (ValueError, KeyError, TypeError)):
+        # The record could be parsed but does not match what the model expects
+        return 422, "invalid_input"
+    return 500, "error"
@@ -0,0 +1,187 @@
+"""
+Runs the API with several worker processes that share the memory of
+the models ("preload and fork").
+
+With `uvicorn --workers N`, each worker is a fresh process that imports the app
+and unpickles its own copy of every model, so memory grows with workers x models.
+Here instead, the parent process loads the models once and then
+creates the workers with fork().
+After a fork, the child process shares all the memory pages of the
+parent, and the operating system only copies a page when one of the
+processes writes to it ("copy-on-write").
+Model parameters are only read when predicting, so they stay shared
+and each extra worker costs little memory.
+
+Run it from the root of the repo:
+
+    python -m src.api.serve --workers 4 --port 8000
+
+Note: when a new version of a model is published, each worker loads it on its own (see
+dsba.model_serving), so that version is not shared until the server is restarted.
+Each worker also has its own metrics, prediction cache and drift monitors: the workers
+publish them in DSBA_WORKER_STATE_DIR (a temporary directory by default) so that
+every worker can report the totals.
+"""
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+from dsba.model_registry import list_models_ids
+from dsba.model_serving import get_model_serving_cache
+
+# A worker that exits sooner than this after being started counts as a failed start
+MIN_WORKER_UPTIME_SECONDS = 10
+MAX_RESTART_DELAY_SECONDS = 60
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Run the DSBA API with preloaded models"
+    )
+    parser.add_argument("--app", default="src.api.api:app", help="ASGI app to serve")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("DSBA_API_WORKERS", "1")),
+        help="Number of worker processes (default: $DSBA_API_WORKERS or 1)",
+    )
+    parser.add_argument(
+        "--models",
+        nargs="*",
+        default=None,
+        help="Model ids to preload (default: all the models of the registry)",
+    )
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    app = import_from_string(args.app)
+
+    model_ids = args.models if args.models is not None else list_models_ids()
+    logging.info(f"Preloading {len(model_ids)} models before forking workers")
+    get_model_serving_cache().preload(model_ids)
+
+    # The garbage collector writes in the header of every object it visits,
+    # which would make the workers copy the pages holding the models.
+    # gc.freeze() moves all the objects created so far out of its reach.
+    gc.collect()
+    gc.freeze()
+
+    sock = _bind_socket(args.host, args.port)
+    if args.workers <= 1:
+        _run_worker(app, sock)
+        return
+
+    # The workers share their metrics, cache and monitoring state
+    # through this directory (see dsba.worker_state)
+    state_dir = Path(
+        os.environ.setdefault(
+            "DSBA_WORKER_STATE_DIR", tempfile.mkdtemp(prefix="dsba-workers-")
+        )
+    )
+    state_dir.mkdir(parents=True, exist_ok=True)
+    for path in state_dir.glob("*.json"):
+        path.unlink()
+
+    worker_start_times = {}
+    for _ in range(args.workers):
+        pid = _fork_worker(app, sock)
+        worker_start_times[pid] = time.monotonic()
+    shutting_down = False
+
+    def stop_workers(signum, frame):
+        nonlocal shutting_down
+        shutting_down = True
+        for pid in worker_start_times:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+
+    # The parent only supervises: it waits for workers to exit and
+    # replaces the ones that died unexpectedly.
+    # A worker that crashes right after starting (e.g. a broken
+    # model, a missing dependency) would crash again:
+    # restarts are delayed, longer and longer, until a worker stays up for a while.
+    failed_starts = 0
+    while worker_start_times:
+        pid, status = os.wait()
+        started_at = worker_start_times.pop(pid, None)
+        (state_dir / f"{pid}.json").unlink(missing_ok=True)
+        if shutting_down or started_at is None:
+            continue
+        if time.monotonic() - started_at < MIN_WORKER_UPTIME_SECONDS:
+            failed_starts += 1
+        else:
+            failed_starts = 0
+        delay = 0
+        if failed_starts:
+            delay = min(MAX_RESTART_DELAY_SECONDS, 2 ** (failed_starts - 1))
+        logging.warning(
+            f"Worker {pid} exited with status {status}, restarting it in {delay}s"
+        )
+        _sleep_unless(lambda: shutting_down, delay)
+        if not shutting_down:
+            new_pid = _fork_worker(app, sock)
+            worker_start_times[new_pid] = time.monotonic()
+
+
+def _sleep_unless(should_stop, seconds: float) -> None:
+    # Short sleeps, so that a SIGTERM received meanwhile doesn't
+    # wait for the end of the delay
+    deadline = time.monotonic() + seconds
+    while not should_stop() and time.monotonic() < deadline:
+        time.sleep(min(0.1, deadline - time.monotonic()))
+
+
+def _bind_socket(host: str, port: int) -> socket.socket:
+    # The socket is created by the parent and inherited by all workers,
+    # the kernel then distributes incoming connections between them
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def _fork_worker(app, sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            _run_worker(app, sock)
+        finally:
+            os._exit(0)
+    logging.info(f"Started worker {pid}")
+    return pid
+
+
+def _run_worker(app, sock: socket.socket) -> None:
+    config = uvicorn.Config(app, log_level="info")
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        datefmt="%H:%M:%S,",
+    )
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Load test of the prediction API: how many requests per second it
+sustains, and where latency falls apart.
+
+It starts the app in this process with uvicorn (or targets a running
+deployment with --url), then sends synthetic records for a registered
+model from --concurrency client threads, for --duration seconds:
+- with --rate, requests are sent on a fixed schedule (an "open
+  loop", like real users who don't wait for each other).
+  Latency is measured from the time a request was scheduled, not from
+  when a client thread was free to send it, so a saturated server shows
+  up as growing latency instead of silently lowering the request rate.
+- without --rate, each client sends its next request as soon as it
+  gets the previous response (a "closed loop"),
+  which measures the maximum throughput.
+
+Synthetic records are drawn from the training data summary stored with
+the model (see dsba.monitoring), or from the rows of --sample-csv.
+
+The report (throughput, p50/p95/p99 latency, errors) is printed and
+saved as JSON in --report-dir, named after the date and the git
+commit, so runs can be compared across commits with --compare.
+
+    python -m src.benchmarks.load_test --model-id my_model \
+        --concurrency 16 --duration 30
+    python -m src.benchmarks.load_test --model-id my_model \
+        --rate 200 --compare load_test_reports/previous.json
+"""
+
+import argparse
+import json
+import random
+import subprocess
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import requests
+import uvicorn
+
+from dsba.model_registry import load_model_metadata
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model-id", required=True)
+    parser.add_argument(
+        "--url", default=None, help="Target a running API instead of starting one"
+    )
+    parser.add_argument(
+        "--app", default="src.api.api:app", help="App started when --url is not given"
+    )
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--endpoint", choices=["predict", "batch"], default="predict")
+    parser.add_argument(
+        "--batch-size", type=int, default=100, help="Records per batch request"
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="Client threads")
+    parser.add_argument(
+        "--rate", type=float, default=None, help="Requests per second (open loop)"
+    )
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds")
+    parser.add_argument(
+        "--warmup", type=float, default=2.0, help="Seconds not measured"
+    )
+    parser.add_argument(
+        "--sample-csv", default=None, help="CSV file to draw records from"
+    )
+    parser.add_argument("--report-dir", default="load_test_reports")
+    parser.add_argument(
+        "--compare", default=None, help="Previous report to compare with"
+    )
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    records = make_records(args, count=10_000)
+
+    server = None
+    base_url = args.url
+    if base_url is None:
+        server = _start_server(args.app, args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        _run_load(base_url, args, records, duration=args.warmup)
+        results = _run_load(base_url, args, records, duration=args.duration)
+    finally:
+        if server is not None:
+            server.should_exit = True
+
+    report = build_report(args, results)
+    print_report(report)
+    report_path = save_report(report, Path(args.report_dir))
+    print(f"Report saved to {report_path}")
+    if args.compare:
+        print_comparison(json.loads(Path(args.compare).read_text()), report)
+
+
+def make_records(args: argparse.Namespace, count: int) -> list[dict]:
+    if args.sample_csv:
+        df = pd.read_csv(args.sample_csv, nrows=count)
+        target_column = load_model_metadata(args.model_id).target_column
+        features = df.drop(columns=[target_column], errors="ignore")
+        return features.to_dict(orient="records")
+    baseline = load_model_metadata(args.model_id).feature_baseline
+    if not baseline:
+        raise ValueError(
+            f"Model {args.model_id} has no training data summary, use --sample-csv"
+        )
+    rng = np.random.default_rng(42)
+    return [_synthetic_record(baseline, rng) for _ in range(count)]
+
+
+def _synthetic_record(baseline: dict, rng: np.random.Generator) -> dict:
+    record = {}
+    for column, summary in baseline.items():
+        if summary["type"] == "numeric":
+            # Pick a bin with the training frequencies, then a value around it
+            edges = summary["bin_edges"] or [0.0]
+            fractions = np.asarray(summary["bin_fractions"], dtype=float)
+            bin_index = rng.choice(len(fractions), p=fractions / fractions.sum())
+            low = edges[max(bin_index - 1, 0)]
+            high = edges[min(bin_index, len(edges) - 1)]
+            record[column] = float(rng.uniform(min(low, high), max(low, high)))
+        else:
+            categories = list(summary["category_fractions"])
+            if not categories:
+                record[column] = None
+                continue
+            weights = np.asarray(list(summary["category_fractions"].values()))
+            index = rng.choice(len(categories), p=weights / weights.sum())
+            record[column] = categories[index]
+    return record
+
+
+def _start_server(app: str, port: int) -> uvicorn.Server:
+    config = uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 60
+    while not server.started:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("The API server did not start")
+        time.sleep(0.05)
+    return server
+
+
+def _run_load(
+    base_url: str, args: argparse.Namespace, records: list[dict], duration: float
+) -> dict:
+    latencies: list[float] = []
+    status_codes: dict[str, int] = {}
+    lock = threading.Lock()
+    start = time.perf_counter()
+    end = start + duration
+    next_request_index = 0
+
+    def next_scheduled_time() -> float | None:
+        # With a rate, the i-th request is due at start + i / rate,
+        # whichever thread sends it
+        nonlocal next_request_index
+        with lock:
+            index = next_request_index
+            next_request_index += 1
+        if args.rate is None:
+            now = time.perf_counter()
+            return now if now < end else None
+        scheduled = start + index / args.rate
+        return scheduled if scheduled < end else None
+
+    def client() -> None:
+        session = requests.Session()
+        rng = random.Random()
+        while (scheduled := next_scheduled_time()) is not None:
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                response = _send(session, base_url, args, records, rng)
+                outcome = str(response.status_code)
+            except requests.RequestException as e:
+                outcome = type(e).__name__
+            latency = time.perf_counter() - scheduled
+            with lock:
+                latencies.append(latency)
+                status_codes[outcome] = status_codes.get(outcome, 0) + 1
+
+    threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "elapsed_seconds": time.perf_counter() - start,
+        "latencies": latencies,
+        "status_codes": status_codes,
+    }
+
+
+def _send(
+    session: requests.Session,
+    base_url: str,
+    args: argparse.Namespace,
+    records: list[dict],
+    rng: random.Random,
+) -> requests.Response:
+    if args.endpoint == "batch":
+        batch = [records[rng.randrange(len(records))] for _ in range(args.batch_size)]
+        return session.post(
+            f"{base_url}/predict/batch/", params={"model_id": args.model_id}, json=batch
+        )
+    record = records[rng.randrange(len(records))]
+    return session.post(
+        f"{base_url}/predict/",
+        params={"model_id": args.model_id, "query": json.dumps(record)},
+    )
+
+
+def build_report(args: argparse.Namespace, results: dict) -> dict:
+    latencies = np.asarray(results["latencies"])
+    total = len(latencies)
+    errors = sum(
+        count for outcome, count in results["status_codes"].items() if outcome != "200"
+    )
+    p50, p95, p99 = (
+        np.percentile(latencies, [50, 95, 99]) if total else (float("nan"),) * 3
+    )
+    return {
+        "date": datetime.now().isoformat(),
+        "git_commit": _git_commit(),
+        "config": {
+            "model_id": args.model_id,
+            "endpoint": args.endpoint,
+            "batch_size": args.batch_size if args.endpoint == "batch" else 1,
+            "concurrency": args.concurrency,
+            "rate": args.rate,
+            "duration": args.duration,
+            "url": args.url,
+        },
+        "requests": total,
+        "requests_per_second": total / results["elapsed_seconds"],
+        "error_rate": errors / total if total else 0.0,
+        "status_codes": results["status_codes"],
+        "latency_ms": {
+            "p50": float(p50) * 1000,
+            "p95": float(p95) * 1000,
+            "p99": float(p99) * 1000,
+            "max": float(latencies.max()) * 1000 if total else float("nan"),
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    latency = report["latency_ms"]
+    print(f"Commit {report['git_commit']}, {report['config']}")
+    print(
+        f"  requests:    {report['requests']} "
+        f"({report['requests_per_second']:.1f} req/s)"
+    )
+    print(f"  error rate:  {report['error_rate']:.2%} {report['status_codes']}")
+    print(
+        f"  latency ms:  p50 {latency['p50']:.1f}  p95 {latency['p95']:.1f}  "
+        f"p99 {latency['p99']:.1f}  max {latency['max']:.1f}"
+    )
+
+
+def print_comparison(previous: dict, current: dict) -> None:
+    print(f"Compared with commit {previous['git_commit']} ({previous['date']}):")
+    rows = [("req/s", "requests_per_second", None), ("error rate", "error_rate", None)]
+    rows += [(f"{p} ms", "latency_ms", p) for p in ("p50", "p95", "p99")]
+    for label, key, sub_key in rows:
+        before = previous[key] if sub_key is None else previous[key][sub_key]
+        after = current[key] if sub_key is None else current[key][sub_key]
+        change = (after - before) / before if before else float("nan")
+        print(f"  {label:>10}: {before:10.2f} -> {after:10.2f} ({change:+.1%})")
+
+
+def save_report(report: dict, report_dir: Path) -> Path:
+    report_dir.mkdir(parents=True, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+    path = report_dir / f"{timestamp}_{report['git_commit'][:10]}.json"
+    path.write_text(json.dumps(report, indent=2))
+    return path
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    main()
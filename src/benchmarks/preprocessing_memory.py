@@ -0,0 +1,99 @@
+"""
+Memory benchmark of preprocess_dataframe on a wide synthetic dataset.
+
+It compares the current implementation with the previous one (label
+encoding of every text column converted to strings, numeric columns
+left as float64/int64), and reports for each:
+- the memory of the DataFrame before and after preprocessing
+- the peak memory allocated while preprocessing (measured with
+  tracemalloc, numpy reports its allocations to it)
+- the duration, measured in a separate run, without tracemalloc
+  (which slows down every allocation)
+
+    python -m src.benchmarks.preprocessing_memory --rows 200000 \
+        --numeric-columns 200 --text-columns 50
+"""
+
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import LabelEncoder
+
+from dsba.preprocessing import fit_categories, preprocess_dataframe
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--numeric-columns", type=int, default=200)
+    parser.add_argument("--text-columns", type=int, default=50)
+    parser.add_argument("--categories", type=int, default=20)
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    print(
+        f"{args.rows} rows, {args.numeric_columns} numeric columns, "
+        f"{args.text_columns} text columns with {args.categories} categories"
+    )
+    # Categories are computed at training time and stored with the
+    # model, so they are not part of the measure
+    categories = fit_categories(make_wide_dataframe(args))
+    for name, func in [
+        ("previous", previous_preprocess_dataframe),
+        ("no categories", preprocess_dataframe),
+        ("current", lambda df: preprocess_dataframe(df, categories)),
+    ]:
+        df = make_wide_dataframe(args)
+        start = time.perf_counter()
+        func(df)
+        duration = time.perf_counter() - start
+        del df
+
+        df = make_wide_dataframe(args)
+        memory_before = df.memory_usage(deep=True).sum()
+        tracemalloc.start()
+        df = func(df)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        memory_after = df.memory_usage(deep=True).sum()
+        print(
+            f"{name:>13}: frame {memory_before / 1e6:8.1f} MB "
+            f"-> {memory_after / 1e6:8.1f} MB, "
+            f"peak allocated while preprocessing {peak / 1e6:8.1f} MB, "
+            f"{duration:6.2f} s"
+        )
+        del df
+
+
+def make_wide_dataframe(args: argparse.Namespace) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    columns = {}
+    for i in range(args.numeric_columns):
+        if i % 2 == 0:
+            columns[f"float_{i}"] = rng.normal(size=args.rows)
+        else:
+            columns[f"int_{i}"] = rng.integers(0, 100, size=args.rows)
+    categories = np.array(
+        [f"category_{i}" for i in range(args.categories)], dtype=object
+    )
+    for i in range(args.text_columns):
+        columns[f"text_{i}"] = categories[
+            rng.integers(0, args.categories, size=args.rows)
+        ]
+    return pd.DataFrame(columns)
+
+
+def previous_preprocess_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    for column in df.select_dtypes(include=["object"]):
+        le = LabelEncoder()
+        df[column] = le.fit_transform(df[column].astype(str))
+    return df
+
+
+if __name__ == "__main__":
+    main()
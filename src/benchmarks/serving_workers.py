@@ -0,0 +1,139 @@
+"""
+Benchmark of the multi-worker API (src/api/serve.py): memory per
+worker and throughput as the number of workers grows.
+
+For each worker count, it starts the server, sends prediction requests
+from several client threads for a while, then reads the memory of
+every worker process from /proc (so it only works on Linux):
+- RSS (resident set size) counts all the memory pages the process
+  uses, including the pages shared with the others
+- PSS (proportional set size) divides each shared page between the
+  processes that share it,
+  the sum of the PSS of all workers is the real memory used by the server
+
+Run it from the root of the repo, with DSBA_MODELS_ROOT_PATH set:
+
+    python -m src.benchmarks.serving_workers --model-id my_model \
+        --record '{"feature": 1.0}' --workers 1 2 4 8
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--model-id", required=True)
+    parser.add_argument("--record", required=True, help="JSON record to score")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--clients", type=int, default=16, help="Client threads")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds per run")
+    parser.add_argument("--output", default=None, help="Write the results as JSON")
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    results = [run_one(args, workers) for workers in args.workers]
+
+    print(
+        f"{'workers':>8} {'req/s':>10} "
+        f"{'RSS/worker MB':>14} {'PSS/worker MB':>14} {'total PSS MB':>13}"
+    )
+    for r in results:
+        print(
+            f"{r['workers']:>8} {r['requests_per_second']:>10.1f} "
+            f"{r['mean_rss_mb']:>14.1f} {r['mean_pss_mb']:>14.1f} "
+            f"{r['total_pss_mb']:>13.1f}"
+        )
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+
+
+def run_one(args: argparse.Namespace, workers: int) -> dict:
+    server = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "src.api.serve",
+            "--workers",
+            str(workers),
+            "--port",
+            str(args.port),
+            "--models",
+            args.model_id,
+        ]
+    )
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        _wait_until_ready(base_url)
+        request_count = _send_requests(base_url, args)
+        worker_pids = _get_children_pids(server.pid) if workers > 1 else [server.pid]
+        memory = [_read_memory_mb(pid) for pid in worker_pids]
+    finally:
+        server.terminate()
+        server.wait()
+
+    return {
+        "workers": workers,
+        "requests_per_second": request_count / args.duration,
+        "mean_rss_mb": sum(rss for rss, _ in memory) / len(memory),
+        "mean_pss_mb": sum(pss for _, pss in memory) / len(memory),
+        "total_pss_mb": sum(pss for _, pss in memory),
+    }
+
+
+def _send_requests(base_url: str, args: argparse.Namespace) -> int:
+    params = {"model_id": args.model_id, "query": args.record}
+    deadline = time.monotonic() + args.duration
+    counts = [0] * args.clients
+
+    def client(index: int) -> None:
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            session.post(f"{base_url}/predict/", params=params).raise_for_status()
+            counts[index] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts)
+
+
+def _wait_until_ready(base_url: str, timeout_seconds: float = 60) -> None:
+    deadline = time.monotonic() + timeout_seconds
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base_url}/models/", timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise TimeoutError(f"Server at {base_url} did not start in {timeout_seconds}s")
+
+
+def _get_children_pids(pid: int) -> list[int]:
+    children = Path(f"/proc/{pid}/task/{pid}/children").read_text().split()
+    return [int(child) for child in children]
+
+
+def _read_memory_mb(pid: int) -> tuple[float, float]:
+    """Returns the RSS and the PSS of a process, in MB"""
+    values = {}
+    for line in Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()[1:]:
+        name, value = line.split(":", 1)
+        values[name] = int(value.split()[0])  # in kB
+    return values["Rss"] / 1024, values["Pss"] / 1024
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Benchmark of the compiled tree engine (dsba.tree_engine) against XGBoost's own predict.
+
+It trains an XGBClassifier on synthetic data (with missing values, so the default
+directions are exercised), checks that both engines give the same predictions,
+and measures the latency of one predict call for several batch sizes.
+
+    python -m src.benchmarks.tree_engine --trees 100 --depth 6 --classes 2
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from dsba.tree_engine import compile_xgboost_model
+
+# Sums of float32 leaf values computed in a different order differ by a few ulps
+MAX_MARGIN_DIFFERENCE = 1e-4
+# Missing values in the synthetic data, so that the default directions are used
+MISSING_FRACTION = 0.05
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=20_000, help="Training rows")
+    parser.add_argument("--features", type=int, default=30)
+    parser.add_argument("--trees", type=int, default=100)
+    parser.add_argument("--depth", type=int, default=6)
+    parser.add_argument("--classes", type=int, default=2)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 10, 1000])
+    parser.add_argument("--repeat", type=int, default=200, help="Calls per batch size")
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    train_features, y = make_dataset(args.rows, args.features, args.classes)
+    model = xgb.XGBClassifier(
+        n_estimators=args.trees, max_depth=args.depth, random_state=42
+    )
+    model.fit(train_features, y)
+    compiled = compile_xgboost_model(model)
+
+    test_features, _ = make_dataset(10_000, args.features, args.classes, seed=1)
+    check_predictions(model, compiled, test_features)
+
+    print(f"{args.trees} trees of depth {args.depth}, {args.features} features")
+    print(f"{'batch size':>10} {'xgboost ms':>12} {'compiled ms':>12} {'speedup':>8}")
+    for batch_size in args.batch_sizes:
+        batch = test_features.iloc[:batch_size]
+        native_ms = time_call(lambda batch=batch: model.predict(batch), args.repeat)
+        compiled_ms = time_call(
+            lambda batch=batch: compiled.predict(batch), args.repeat
+        )
+        print(
+            f"{batch_size:>10} {native_ms:>12.3f} {compiled_ms:>12.3f} "
+            f"{native_ms / compiled_ms:>7.1f}x"
+        )
+
+
+def make_dataset(
+    rows: int, features: int, classes: int, seed: int = 0
+) -> tuple[pd.DataFrame, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(rows, features)).astype(np.float32)
+    weights = np.random.default_rng(42).normal(size=(features, classes))
+    y = (values @ weights + rng.normal(scale=0.5, size=(rows, classes))).argmax(axis=1)
+    values[rng.random(values.shape) < MISSING_FRACTION] = np.nan
+    return pd.DataFrame(values, columns=[f"f{i}" for i in range(features)]), y
+
+
+def check_predictions(
+    model: xgb.XGBClassifier, compiled, features: pd.DataFrame
+) -> None:
+    native_margins = model.predict(features, output_margin=True).reshape(
+        len(features), -1
+    )
+    margin_diff = np.abs(native_margins - compiled.predict_margin(features)).max()
+    proba_diff = np.abs(
+        model.predict_proba(features) - compiled.predict_proba(features)
+    ).max()
+    agreement = (model.predict(features) == compiled.predict(features)).mean()
+    print(
+        f"Max margin difference {margin_diff:.2e}, "
+        f"max probability difference {proba_diff:.2e}, "
+        f"same label for {agreement:.4%} of the rows"
+    )
+    # Timings of an engine that gives other predictions would be meaningless
+    if margin_diff > MAX_MARGIN_DIFFERENCE:
+        raise AssertionError(f"The engines disagree: margin difference {margin_diff}")
+
+
+def time_call(func, repeat: int) -> float:
+    """Median duration of a call, in milliseconds"""
+    func()  # warm up
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return float(np.median(durations)) * 1000
+
+
+if __name__ == "__main__":
+    main()
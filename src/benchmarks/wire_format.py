@@ -0,0 +1,141 @@
+"""
+Compares the cost of sending records for scoring as JSON and as
+Arrow (IPC stream and Parquet).
+
+By default it measures, on a synthetic dataset, the serialization
+work done for one bulk scoring request:
+the client encodes the records, the server decodes them into a
+DataFrame, and the same for the predictions on the way back.
+With --url and --model-id it also measures the full round trip against a running API
+(the synthetic columns must then match the features of the model, see --columns).
+
+    python -m src.benchmarks.wire_format --rows 100000 --columns 20
+    python -m src.benchmarks.wire_format --url http://127.0.0.1:8000 \
+        --model-id my_model --columns 8
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import requests
+
+from dsba.arrow_format import (
+    ARROW_STREAM_MEDIA_TYPE,
+    PARQUET_MEDIA_TYPE,
+    read_dataframe_from_bytes,
+    write_dataframe_to_bytes,
+)
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3, help="Keep the best of N runs")
+    parser.add_argument("--url", default=None, help="Base URL of a running API")
+    parser.add_argument("--model-id", default=None)
+    return parser
+
+
+def main() -> None:
+    args = create_parser().parse_args()
+    df = make_synthetic_dataframe(args.rows, args.columns)
+    predictions = pd.DataFrame({"target": np.random.randint(0, 2, args.rows)})
+
+    print(f"Serialization round trip for {args.rows} records x {args.columns} columns")
+    results = {
+        "json": _best_of(args.repeat, lambda: json_round_trip(df, predictions)),
+        "arrow": _best_of(
+            args.repeat,
+            lambda: binary_round_trip(df, predictions, ARROW_STREAM_MEDIA_TYPE),
+        ),
+        "parquet": _best_of(
+            args.repeat,
+            lambda: binary_round_trip(df, predictions, PARQUET_MEDIA_TYPE),
+        ),
+    }
+    _print_results(results, args.rows)
+
+    if args.url and args.model_id:
+        print(f"\nEnd to end scoring against {args.url}")
+        results = {
+            "json": _best_of(args.repeat, lambda: http_json(args, df)),
+            "arrow": _best_of(
+                args.repeat, lambda: http_binary(args, df, ARROW_STREAM_MEDIA_TYPE)
+            ),
+            "parquet": _best_of(
+                args.repeat, lambda: http_binary(args, df, PARQUET_MEDIA_TYPE)
+            ),
+        }
+        _print_results(results, args.rows)
+
+
+def make_synthetic_dataframe(rows: int, columns: int) -> pd.DataFrame:
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({f"feature_{i}": rng.normal(size=rows) for i in range(columns)})
+
+
+def json_round_trip(df: pd.DataFrame, predictions: pd.DataFrame) -> None:
+    # What the client and the batch endpoint do with a JSON body
+    body = json.dumps(df.to_dict(orient="records"))
+    received_df = pd.DataFrame(json.loads(body))
+    response = json.dumps({"predictions": predictions["target"].tolist()})
+    json.loads(response)
+    assert len(received_df) == len(df)
+
+
+def binary_round_trip(
+    df: pd.DataFrame, predictions: pd.DataFrame, media_type: str
+) -> None:
+    body = write_dataframe_to_bytes(df, media_type)
+    received_df = read_dataframe_from_bytes(body, media_type)
+    response = write_dataframe_to_bytes(predictions, media_type)
+    read_dataframe_from_bytes(response, media_type)
+    assert len(received_df) == len(df)
+
+
+def http_json(args: argparse.Namespace, df: pd.DataFrame) -> None:
+    response = requests.post(
+        f"{args.url}/predict/batch/",
+        params={"model_id": args.model_id},
+        data=json.dumps(df.to_dict(orient="records")),
+        headers={"Content-Type": "application/json"},
+    )
+    response.raise_for_status()
+    response.json()
+
+
+def http_binary(args: argparse.Namespace, df: pd.DataFrame, media_type: str) -> None:
+    response = requests.post(
+        f"{args.url}/predict/arrow/",
+        params={"model_id": args.model_id},
+        data=write_dataframe_to_bytes(df, media_type),
+        headers={"Content-Type": media_type, "Accept": media_type},
+    )
+    response.raise_for_status()
+    read_dataframe_from_bytes(response.content, media_type)
+
+
+def _best_of(repeat: int, func) -> float:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def _print_results(results: dict[str, float], rows: int) -> None:
+    json_duration = results["json"]
+    for name, duration in results.items():
+        print(
+            f"{name:>8}: {duration * 1000:9.1f} ms  {rows / duration:12.0f} records/s"
+            f"  ({json_duration / duration:5.1f}x vs json)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+"""
+Background batch scoring jobs, for files too large to be scored within an HTTP request.
+
+A job scores a CSV file with a model, chunk by chunk, and writes one output file per
+chunk (<output_dir>/part-00000.csv, part-00001.csv...) as soon as the chunk is scored.
+The state of the jobs is kept in a SQLite table, updated after each chunk,
+so a job interrupted by a restart resumes after its last completed chunk.
+
+Jobs are processed by a pool of worker threads (JobRunner). Several
+processes can share the same job table:
+a job is claimed in a SQLite transaction, so it is only processed once.
+
+A claimed job is leased: its runner refreshes its "heartbeat_at"
+after each chunk and every few seconds.
+A running job whose heartbeat is older than DSBA_JOB_LEASE_SECONDS (default
+300) is considered abandoned (the process died, the container was
+recreated...) and put back in the queue by any runner, which checks regularly.
+Chunks longer than the lease are fine, the heartbeat is refreshed by a separate thread.
+
+All the files of the subsystem live in DSBA_JOBS_PATH (default: ./jobs): the
+input and output paths of the jobs are relative to it, and jobs reading or
+writing outside of it are refused.
+"""
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+from dsba.model_prediction import classify_dataframe, select_inference_engine
+from dsba.model_registry import get_model_version, load_model_and_metadata
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+
+@dataclass
+class ScoringJob:
+    id: str
+    model_id: str
+    # The version is fixed when the job is submitted, so a resumed
+    # job keeps scoring with the same model
+    model_version: str
+    input_path: str
+    output_dir: str
+    chunk_size: int
+    status: str
+    chunks_done: int
+    rows_done: int
+    # Estimated from the number of lines of the input file, for progress reporting
+    total_rows: int | None
+    owner: str | None
+    error: str | None
+    created_at: str
+    updated_at: str
+    # Last time the owner showed it is still working on the job,
+    # None when it is not running
+    heartbeat_at: str | None = None
+
+    @property
+    def progress(self) -> float | None:
+        if self.status == SUCCEEDED:
+            return 1.0
+        if not self.total_rows:
+            return None
+        return min(self.rows_done / self.total_rows, 1.0)
+
+
+class JobStore:
+    def __init__(self, db_path: str | Path, files_dir: str | Path | None = None):
+        self.db_path = str(db_path)
+        # Directory that the input and output paths of the jobs must be in,
+        # by default the one of the database
+        self.files_dir = Path(files_dir or Path(db_path).parent).resolve()
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    model_id TEXT NOT NULL,
+                    model_version TEXT NOT NULL,
+                    input_path TEXT NOT NULL,
+                    output_dir TEXT NOT NULL,
+                    chunk_size INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    chunks_done INTEGER NOT NULL,
+                    rows_done INTEGER NOT NULL,
+                    total_rows INTEGER,
+                    owner TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    heartbeat_at TEXT
+                )
+                """
+            )
+            # Tables created before leases existed
+            columns = [row["name"] for row in conn.execute("PRAGMA table_info(jobs)")]
+            if "heartbeat_at" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat_at TEXT")
+
+    def create(
+        self, model_id: str, input_path: str, output_dir: str, chunk_size: int
+    ) -> ScoringJob:
+        now = _now()
+        job = ScoringJob(
+            id=uuid.uuid4().hex,
+            model_id=model_id,
+            model_version=get_model_version(model_id),
+            input_path=str(self.resolve_path(input_path)),
+            output_dir=str(self.resolve_path(output_dir)),
+            chunk_size=chunk_size,
+            status=QUEUED,
+            chunks_done=0,
+            rows_done=0,
+            total_rows=None,
+            owner=None,
+            error=None,
+            created_at=now,
+            updated_at=now,
+        )
+        with self._connect() as conn:
+            columns = list(job.__dataclass_fields__)
+            conn.execute(
+                f"INSERT INTO jobs ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' for _ in columns)})",
+                [getattr(job, column) for column in columns],
+            )
+        return job
+
+    def resolve_path(self, path: str | Path) -> Path:
+        """
+        Absolute path of a file of a job, relative paths being relative to files_dir.
+        Raises a ValueError if it is outside of files_dir (symbolic links
+        included), since the paths of a job come from its client.
+        """
+        resolved = (self.files_dir / path).resolve()
+        if not resolved.is_relative_to(self.files_dir):
+            raise ValueError(f"{path} is not in the jobs directory")
+        return resolved
+
+    def get(self, job_id: str) -> ScoringJob | None:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", [job_id]).fetchone()
+        return ScoringJob(**row) if row else None
+
+    def list_jobs(self) -> list[ScoringJob]:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT * FROM jobs ORDER BY created_at").fetchall()
+        return [ScoringJob(**row) for row in rows]
+
+    def claim_next(self, owner: str) -> ScoringJob | None:
+        """Marks the oldest queued job as running for this owner, and returns it"""
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE takes the write lock right away, so two
+            # workers can't claim the same job
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                [QUEUED],
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            now = _now()
+            conn.execute(
+                "UPDATE jobs SET status = ?, owner = ?, updated_at = ?, "
+                "heartbeat_at = ? WHERE id = ?",
+                [RUNNING, owner, now, now, row["id"]],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return self.get(row["id"])
+
+    def update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = _now()
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?",
+                [*fields.values(), job_id],
+            )
+
+    def record_progress(
+        self, job_id: str, owner: str, chunks_done: int, rows_done: int
+    ) -> bool:
+        """
+        Saves the progress of a job, if it is still leased by this owner.
+        Returns False if the lease was lost (the job was requeued and
+        maybe claimed by another runner).
+        """
+        now = _now()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET chunks_done = ?, rows_done = ?, updated_at = ?, "
+                "heartbeat_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                [chunks_done, rows_done, now, now, job_id, owner, RUNNING],
+            )
+        return cursor.rowcount > 0
+
+    def finish(
+        self, job_id: str, owner: str, status: str, error: str | None = None
+    ) -> bool:
+        """
+        Marks a job as succeeded or failed, if it is still leased by this owner
+        (see record_progress).
+        """
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? "
+                "WHERE id = ? AND owner = ? AND status = ?",
+                [status, error, _now(), job_id, owner, RUNNING],
+            )
+        return cursor.rowcount > 0
+
+    def heartbeat(self, owner: str) -> None:
+        """Renews the lease of all the jobs run by this owner"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE owner = ? AND status = ?",
+                [_now(), owner, RUNNING],
+            )
+
+    def requeue_orphaned_jobs(self, lease_seconds: float | None = None) -> int:
+        """
+        Puts back in the queue the running jobs whose lease expired:
+        their runner stopped sending heartbeats (e.g. the process was
+        killed). They will resume from their last completed chunk.
+        """
+        if lease_seconds is None:
+            lease_seconds = get_lease_seconds()
+        expired_before = (datetime.now() - timedelta(seconds=lease_seconds)).isoformat()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, owner = NULL, heartbeat_at = NULL, "
+                "updated_at = ? "
+                "WHERE status = ? AND (heartbeat_at IS NULL OR heartbeat_at < ?)",
+                [QUEUED, _now(), RUNNING, expired_before],
+            )
+        return cursor.rowcount
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+
+class JobRunner:
+    def __init__(
+        self, store: JobStore, workers: int = 2, poll_interval_seconds: float = 2
+    ):
+        self.store = store
+        self.workers = workers
+        self.poll_interval_seconds = poll_interval_seconds
+        # Unique even if a recreated container gets the same hostname
+        # and pid as a previous one
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.lease_seconds = get_lease_seconds()
+        self._stop_event = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self) -> None:
+        self._requeue_orphaned_jobs()
+        self._stop_event.clear()
+        self._threads = [
+            threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        self._threads.append(
+            threading.Thread(target=self._renew_leases, name="job-leases", daemon=True)
+        )
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self) -> None:
+        """
+        Workers finish the chunk they are scoring, the rest of their
+        job is resumed at the next start
+        """
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        for job in self.store.list_jobs():
+            if job.status == RUNNING and job.owner == self.owner:
+                self.store.update(job.id, status=QUEUED, owner=None, heartbeat_at=None)
+
+    def _renew_leases(self) -> None:
+        # Several heartbeats per lease, so that one slow write to the
+        # database doesn't lose it
+        while not self._stop_event.wait(self.lease_seconds / 5):
+            try:
+                self.store.heartbeat(self.owner)
+                self._requeue_orphaned_jobs()
+            except Exception as e:
+                logging.error(f"Failed to renew the leases of the scoring jobs: {e}")
+
+    def _requeue_orphaned_jobs(self) -> None:
+        requeued = self.store.requeue_orphaned_jobs(self.lease_seconds)
+        if requeued:
+            logging.info(f"Resuming {requeued} interrupted scoring jobs")
+
+    def _work(self) -> None:
+        while not self._stop_event.is_set():
+            job = self.store.claim_next(self.owner)
+            if job is None:
+                self._stop_event.wait(self.poll_interval_seconds)
+                continue
+            try:
+                self._run(job)
+            except Exception as e:
+                logging.error(f"Scoring job {job.id} failed: {e}")
+                # A runner which lost its lease must not overwrite the
+                # status of the job, another runner may be processing it
+                self.store.finish(job.id, self.owner, FAILED, str(e))
+
+    def _run(self, job: ScoringJob) -> None:
+        logging.info(f"Scoring job {job.id} starting at chunk {job.chunks_done}")
+        # Checked again here for the jobs submitted before the paths were restricted
+        input_path = self.store.resolve_path(job.input_path)
+        output_dir = self.store.resolve_path(job.output_dir)
+        model, metadata = load_model_and_metadata(job.model_id, job.model_version)
+        model = select_inference_engine(model, metadata, job.model_version)
+        if job.total_rows is None:
+            job.total_rows = _count_data_lines(input_path)
+            self.store.update(job.id, total_rows=job.total_rows)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        rows_done = job.rows_done
+        reader = pd.read_csv(input_path, chunksize=job.chunk_size)
+        for chunk_index, chunk in enumerate(reader):
+            if chunk_index < job.chunks_done:
+                continue  # already scored before the interruption
+            if self._stop_event.is_set():
+                return
+            scored = classify_dataframe(
+                model, chunk, metadata.target_column, categories=metadata.categories
+            )
+            _write_part_atomically(scored, output_dir / f"part-{chunk_index:05d}.csv")
+            rows_done += len(scored)
+            if not self.store.record_progress(
+                job.id, self.owner, chunk_index + 1, rows_done
+            ):
+                logging.warning(f"Scoring job {job.id} was requeued, stopping it here")
+                return
+        if not self.store.finish(job.id, self.owner, SUCCEEDED):
+            logging.warning(f"Scoring job {job.id} was requeued, not marking it done")
+            return
+        logging.info(f"Scoring job {job.id} done: {rows_done} rows")
+
+
+def _write_part_atomically(df: pd.DataFrame, path: Path) -> None:
+    # If we crash while writing, only the temporary file is
+    # incomplete, and the chunk is scored again on resume
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def _count_data_lines(path: str | Path) -> int:
+    """
+    Number of lines of the file minus the header, read by blocks so
+    it is fast even on large files
+    """
+    lines = 0
+    with open(path, "rb") as f:
+        while block := f.read(1 << 20):
+            lines += block.count(b"\n")
+    return max(lines - 1, 0)
+
+
+def get_lease_seconds() -> float:
+    return float(os.getenv("DSBA_JOB_LEASE_SECONDS", "300"))
+
+
+def _now() -> str:
+    return datetime.now().isoformat()
+
+
+def get_jobs_dir() -> Path:
+    jobs_dir = Path(os.getenv("DSBA_JOBS_PATH", "jobs")).expanduser().resolve()
+    jobs_dir.mkdir(parents=True, exist_ok=True)
+    return jobs_dir
+
+
+_default_store: JobStore | None = None
+
+
+def get_job_store() -> JobStore:
+    """Returns the job store of DSBA_JOBS_PATH, shared by the whole process"""
+    global _default_store  # noqa: PLW0603  (created on first use)
+    if _default_store is None:
+        jobs_dir = get_jobs_dir()
+        _default_store = JobStore(jobs_dir / "jobs.sqlite3", jobs_dir)
+    return _default_store
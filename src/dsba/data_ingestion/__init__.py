@@ -1 +1,14 @@
 from .files import load_csv_from_path, load_csv_from_url, write_csv_to_path
+from .incremental import compact_snapshot, load_snapshot, sync_table
+from .writers import DatasetWriter, write_dataframe
+
+__all__ = [
+    "DatasetWriter",
+    "compact_snapshot",
+    "load_csv_from_path",
+    "load_csv_from_url",
+    "load_snapshot",
+    "sync_table",
+    "write_csv_to_path",
+    "write_dataframe",
+]
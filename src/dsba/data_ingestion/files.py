@@ -6,6 +6,7 @@ import pandas as pd
 
 import os
 from dsba.simple_cache import cache_to_disk
+from dsba.data_ingestion.writers import write_dataframe
 
 
 def load_csv_from_path(filepath: str | Path) -> pd.DataFrame:
@@ -23,7 +24,12 @@ def load_csv_from_url(url: str) -> pd.DataFrame:
 
 
 def write_csv_to_path(df: pd.DataFrame, filepath: str | Path) -> None:
-    df.to_csv(filepath, index=False)
+    """
+    Writes a DataFrame to a CSV file, compressed if the name ends with .gz or .zst.
+    The file appears at its path only once it is complete
+    (see dsba.data_ingestion.writers).
+    """
+    write_dataframe(df, filepath, format="csv")
 
 
 
@@ -0,0 +1,348 @@
+"""
+Incremental copy of Postgres tables into a local Parquet snapshot,
+so training doesn't re-download whole tables.
+
+Each table is synced using a "watermark" column whose value only
+grows: an auto-incremented id for tables where rows are only inserted,
+or an "updated_at" timestamp for tables where rows are also modified.
+A sync only fetches the rows whose watermark is greater than the largest
+one already copied, and appends them to the snapshot as a new batch. Rows
+where the watermark column is NULL can't be ordered, they are never copied.
+
+    <DSBA_SNAPSHOTS_PATH>/<table>/batch=00000/part-00000.parquet
+                                 /batch=00001/part-00000.parquet
+                                 /_state.json
+
+_state.json holds the watermark and the list of complete batches. It is
+replaced atomically after a batch is written, so it is the commit point:
+a sync interrupted midway leaves a batch that is not listed, ignored on
+read and deleted by the next sync, which fetches the same rows again.
+
+A modified row is copied again with its new values.
+load_snapshot(table, primary_key=...) keeps the latest copy of each row,
+and compact_snapshot() rewrites the snapshot with only those latest copies.
+Deleted rows are not seen by an incremental sync:
+use full_refresh=True from time to time if the table has deletes.
+
+A watermark can be committed out of order: a transaction that sets
+updated_at = now() but commits a few seconds later becomes visible after
+rows with a larger updated_at were already copied, and would be missed.
+With a `lookback` (e.g. timedelta(minutes=5), or a number for numeric watermarks),
+a sync fetches again the rows whose watermark is within the lookback of the largest
+one copied. The rows of that window are copied again at every sync: read the snapshot
+with a primary key (and compact it from time to time) to drop these duplicates.
+
+    python -m dsba.data_ingestion.incremental classifier_data \
+        --watermark-column updated_at --primary-key id --compact-min-batches 20
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import uuid
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy
+
+from dsba.data_ingestion.databases import PostgresConfig
+
+STATE_FILE = "_state.json"
+
+# Table and column names are inserted in the SQL text, so only
+# plain identifiers are accepted
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+
+def sync_table(  # noqa: PLR0913, PLR0917  (options of the sync, with defaults)
+    config: PostgresConfig,
+    table: str,
+    watermark_column: str,
+    snapshot_root: str | Path | None = None,
+    chunksize: int = 100_000,
+    full_refresh: bool = False,
+    lookback: timedelta | float | None = None,
+) -> int:
+    """
+    Copies the new and modified rows of a table into its local
+    snapshot, and returns the number of rows copied.
+    Rows are read from the database by chunks of `chunksize` rows, and each chunk
+    is written to its own Parquet file, so the whole table is never in memory.
+    With full_refresh=True the snapshot is rebuilt from the whole table.
+    With a lookback, rows whose watermark is up to `lookback` below the stored
+    watermark are fetched again, to catch rows committed late (see the module
+    docstring). A number is taken as seconds for timestamp watermarks.
+    """
+    for name in (table, watermark_column):
+        if not _IDENTIFIER.match(name):
+            raise ValueError(f"Invalid table or column name: {name}")
+    table_dir = get_snapshot_dir(table, snapshot_root)
+    table_dir.mkdir(parents=True, exist_ok=True)
+    stored_state = _read_state(table_dir)
+    _remove_uncommitted_batches(table_dir, stored_state.get("batches", []))
+    # With a full refresh, the current snapshot stays readable until
+    # the new one is complete
+    state = {} if full_refresh else stored_state
+    if state and state["watermark_column"] != watermark_column:
+        raise ValueError(
+            f"The snapshot of {table} was synced on {state['watermark_column']}, "
+            f"use full_refresh=True to change the watermark column"
+        )
+    next_batch = stored_state.get("next_batch", 0)
+
+    watermark = _decode_watermark(state.get("watermark"))
+    # NULL sorts last in Postgres: it would become the stored
+    # watermark, and break every following sync
+    query = f"SELECT * FROM {table} WHERE {watermark_column} IS NOT NULL"
+    params = {}
+    if watermark is not None:
+        if lookback is None:
+            query += f" AND {watermark_column} > :watermark"
+            params["watermark"] = watermark
+        else:
+            query += f" AND {watermark_column} >= :watermark"
+            params["watermark"] = watermark - _as_delta(lookback, watermark)
+    query += f" ORDER BY {watermark_column}"
+
+    batch = f"batch={next_batch:05d}"
+    tmp_batch_dir = table_dir / f".{batch}.tmp-{uuid.uuid4().hex}"
+    tmp_batch_dir.mkdir()
+    rows = 0
+    try:
+        with _connect(config) as connection:
+            # stream_results uses a server-side cursor, so chunks are
+            # really fetched one by one
+            streaming_connection = connection.execution_options(stream_results=True)
+            chunks = pd.read_sql(
+                sqlalchemy.text(query),
+                streaming_connection,
+                params=params,
+                chunksize=chunksize,
+            )
+            for part, chunk in enumerate(chunks):
+                if chunk.empty:
+                    continue
+                chunk.to_parquet(
+                    tmp_batch_dir / f"part-{part:05d}.parquet", index=False
+                )
+                rows += len(chunk)
+                # With a lookback the first rows are below the stored
+                # watermark, which must never go back
+                chunk_watermark = chunk[watermark_column].dropna().max()
+                if not pd.isna(chunk_watermark) and (
+                    watermark is None or chunk_watermark > watermark
+                ):
+                    watermark = chunk_watermark
+    except BaseException:
+        shutil.rmtree(tmp_batch_dir, ignore_errors=True)
+        raise
+
+    if rows == 0:
+        shutil.rmtree(tmp_batch_dir)
+        logging.info(f"Snapshot of {table} is up to date")
+        return 0
+
+    os.replace(tmp_batch_dir, table_dir / batch)
+    new_state = {
+        "table": table,
+        "watermark_column": watermark_column,
+        "watermark": _encode_watermark(watermark),
+        "batches": [*state.get("batches", []), batch],
+        "next_batch": next_batch + 1,
+    }
+    _write_state(table_dir, new_state)
+    if full_refresh:
+        # The batches of the previous snapshot are no longer listed
+        # in the state, they can go
+        _remove_uncommitted_batches(table_dir, new_state["batches"])
+    logging.info(f"Copied {rows} rows of {table} into {table_dir / batch}")
+    return rows
+
+
+def load_snapshot(
+    table: str,
+    primary_key: str | list[str] | None = None,
+    columns: list[str] | None = None,
+    snapshot_root: str | Path | None = None,
+) -> pd.DataFrame:
+    """
+    Reads the local snapshot of a table, e.g. to train a model on it.
+    With a primary key, only the latest copy of each row is kept (rows modified
+    after their first sync appear in several batches).
+    The primary key columns must be part of `columns` if columns are given.
+    """
+    table_dir = get_snapshot_dir(table, snapshot_root)
+    state = _read_state(table_dir)
+    if not state:
+        raise FileNotFoundError(f"No snapshot of {table} in {table_dir}, sync it first")
+    files = [
+        path
+        for batch in state["batches"]
+        for path in sorted((table_dir / batch).glob("*.parquet"))
+    ]
+    # The schema may change between batches (e.g. a column added to
+    # the table), missing columns are filled with nulls
+    arrow_table = pa.concat_tables(
+        [pq.read_table(path, columns=columns) for path in files],
+        promote_options="permissive",
+    )
+    df = arrow_table.to_pandas(split_blocks=True, self_destruct=True)
+    if primary_key is not None:
+        # Batches and rows within a batch are in sync order, so the
+        # last copy is the most recent one
+        df = df.drop_duplicates(subset=primary_key, keep="last").reset_index(drop=True)
+    return df
+
+
+def compact_snapshot(
+    table: str,
+    primary_key: str | list[str],
+    snapshot_root: str | Path | None = None,
+    min_batches: int = 1,
+) -> bool:
+    """
+    Rewrites the snapshot of a table as one batch with the latest copy of each row.
+    This reads and writes the whole snapshot: with min_batches, it is only done
+    once the syncs have added enough batches, and returns whether it was done.
+    """
+    table_dir = get_snapshot_dir(table, snapshot_root)
+    state = _read_state(table_dir)
+    if len(state.get("batches", [])) < max(min_batches, 1):
+        return False
+    df = load_snapshot(table, primary_key, snapshot_root=snapshot_root)
+    batch = f"batch={state['next_batch']:05d}"
+    tmp_batch_dir = table_dir / f".{batch}.tmp-{uuid.uuid4().hex}"
+    tmp_batch_dir.mkdir()
+    df.to_parquet(tmp_batch_dir / "part-00000.parquet", index=False)
+    os.replace(tmp_batch_dir, table_dir / batch)
+    _write_state(
+        table_dir,
+        {**state, "batches": [batch], "next_batch": state["next_batch"] + 1},
+    )
+    _remove_uncommitted_batches(table_dir, [batch])
+    return True
+
+
+def _as_delta(lookback: timedelta | float, watermark: Any) -> timedelta | float:
+    if isinstance(watermark, datetime) and not isinstance(lookback, timedelta):
+        return timedelta(seconds=lookback)
+    return lookback
+
+
+def get_snapshot_dir(table: str, snapshot_root: str | Path | None = None) -> Path:
+    if snapshot_root is None:
+        snapshot_root = os.getenv("DSBA_SNAPSHOTS_PATH", "snapshots")
+    return Path(snapshot_root).expanduser().resolve() / table
+
+
+def _connect(config: PostgresConfig) -> sqlalchemy.Connection:
+    """Same fallback as query_postgres: direct connection, then the IPv4 pooler"""
+    try:
+        engine = sqlalchemy.create_engine(
+            f"postgresql://{config.user}:{config.password}@"
+            f"{config.host}:{config.port}/{config.database}"
+        )
+        return engine.connect()
+    except sqlalchemy.exc.OperationalError:
+        engine = sqlalchemy.create_engine(
+            f"postgresql://{config.user_pooler}:{config.password}@"
+            f"{config.host_pooler}:{config.port}/{config.database}"
+        )
+        return engine.connect()
+
+
+def _read_state(table_dir: Path) -> dict[str, Any]:
+    state_path = table_dir / STATE_FILE
+    if not state_path.exists():
+        return {}
+    return json.loads(state_path.read_text())
+
+
+def _write_state(table_dir: Path, state: dict[str, Any]) -> None:
+    tmp_path = table_dir / f".{STATE_FILE}.tmp-{uuid.uuid4().hex}"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, table_dir / STATE_FILE)
+
+
+def _remove_uncommitted_batches(table_dir: Path, committed_batches: list[str]) -> None:
+    """Deletes the batches left by an interrupted sync or replaced by a compaction"""
+    for path in table_dir.iterdir():
+        if path.is_dir() and path.name not in committed_batches:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def _encode_watermark(value: Any) -> dict[str, Any]:
+    # JSON has no timestamp type, so we remember the type to restore it
+    if hasattr(value, "isoformat"):  # pd.Timestamp, datetime, date
+        return {"type": "timestamp", "value": pd.Timestamp(value).isoformat()}
+    if hasattr(value, "item"):
+        value = value.item()  # numpy scalar to Python number
+    return {"type": "value", "value": value}
+
+
+def _decode_watermark(encoded: dict[str, Any] | None) -> Any:
+    if encoded is None:
+        return None
+    if encoded["type"] == "timestamp":
+        return pd.Timestamp(encoded["value"]).to_pydatetime()
+    return encoded["value"]
+
+
+def create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Sync a Postgres table into its local snapshot"
+    )
+    parser.add_argument("table")
+    parser.add_argument("--watermark-column", required=True)
+    parser.add_argument(
+        "--primary-key",
+        default=None,
+        help="Primary key of the table, to compact the snapshot on",
+    )
+    parser.add_argument(
+        "--compact-min-batches",
+        type=int,
+        default=None,
+        help="Compact the snapshot on the primary key after the sync, "
+        "once it has at least this many batches",
+    )
+    parser.add_argument("--chunksize", type=int, default=100_000)
+    parser.add_argument("--full-refresh", action="store_true")
+    parser.add_argument(
+        "--lookback",
+        type=float,
+        default=None,
+        help="Fetch again the rows this far below the watermark "
+        "(seconds for timestamps)",
+    )
+    return parser
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = create_parser()
+    args = parser.parse_args()
+    if args.compact_min_batches is not None and not args.primary_key:
+        parser.error("--compact-min-batches requires --primary-key")
+    sync_table(
+        PostgresConfig(),
+        args.table,
+        args.watermark_column,
+        chunksize=args.chunksize,
+        full_refresh=args.full_refresh,
+        lookback=args.lookback,
+    )
+    if args.compact_min_batches is not None:
+        compact_snapshot(
+            args.table, args.primary_key, min_batches=args.compact_min_batches
+        )
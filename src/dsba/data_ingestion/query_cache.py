@@ -0,0 +1,304 @@
+"""
+Cache of the results of read (SELECT) queries, for queries repeated
+often such as dashboards.
+
+Entries are keyed by the normalized SQL text and the role of the
+user (two roles may not be allowed to see the same data).
+They expire after a TTL, and the total size of the cache is bounded
+(least recently used entries are evicted first).
+When a write goes through this module (perform_query,
+add_or_update_user...), the entries reading the tables it touches are
+dropped, so a user never reads stale data after their own writes.
+Writes made by other programs are only seen once the entries expire.
+
+Results are stored as Arrow IPC bytes: compact, and fast to turn back into a DataFrame.
+"""
+
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from dsba.arrow_format import (
+    ARROW_STREAM_MEDIA_TYPE,
+    read_dataframe_from_bytes,
+    write_dataframe_to_bytes,
+)
+
+_STRING = r"'(?:[^']|'')*'"
+_QUOTED_IDENTIFIER = r'"(?:[^"]|"")*"'
+# PostgreSQL dollar-quoted string: $$...$$ or $tag$...$tag$
+# (not "$1", a parameter, nor the "$" of an identifier such as "a$b")
+_DOLLAR_QUOTED_STRING = r"(?<![\w$])\$(?P<tag>(?:[^\W\d]\w*)?)\$[\s\S]*?\$(?P=tag)\$"
+# Quoted strings and identifiers must be kept as they are, the rest
+# of the query can be normalized
+_QUOTED_PARTS = re.compile(
+    "|".join([_STRING, _QUOTED_IDENTIFIER, _DOLLAR_QUOTED_STRING])
+)
+# Tokens of a normalized query: strings, quoted identifiers,
+# identifiers or keywords, numbers, any other character
+_TOKEN = re.compile(
+    "|".join(
+        [
+            _STRING,
+            _QUOTED_IDENTIFIER,
+            _DOLLAR_QUOTED_STRING,
+            r"[a-z_][\w$]*",
+            r"\d+(?:\.\d+)?",
+            r"\S",
+        ]
+    )
+)
+# Keywords followed by a table name
+_TABLE_KEYWORDS = {"from", "join", "into", "update", "table", "truncate"}
+# Keywords followed by a list of tables separated by commas
+_TABLE_LIST_KEYWORDS = {"from", "table", "truncate"}
+# Keywords that can come between a table keyword and the table name
+_TABLE_MODIFIERS = {"only", "lateral", "table", "if", "not", "exists"}
+# Keywords starting a query, in a subquery or a CTE
+_QUERY_KEYWORDS = {"select", "with", "values", "insert", "update", "delete"}
+# Keywords that can follow a table in a FROM list, where an alias
+# could otherwise be expected
+_CLAUSE_KEYWORDS = {
+    "where", "join", "inner", "left", "right", "full", "cross", "natural", "on",
+    "using", "group", "order", "limit", "offset", "having", "union", "intersect",
+    "except", "window", "for", "returning", "set", "values", "select", "fetch", "as",
+    "tablesample",
+}  # fmt: skip
+
+
+class QueryResultCache:
+    def __init__(self, ttl_seconds: float = 60, max_bytes: int = 64 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        # key -> (expiry time, tables read by the query or None if
+        # unknown, Arrow bytes of the result)
+        self._entries: OrderedDict[
+            tuple[str, str], tuple[float, frozenset[str] | None, bytes]
+        ] = OrderedDict()
+        self._size_bytes = 0
+        # Incremented on every invalidation, see put()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get(self, query: str, role: str) -> pd.DataFrame | None:
+        key = (normalize_sql(query), role)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            data = entry[2]
+        return read_dataframe_from_bytes(data, ARROW_STREAM_MEDIA_TYPE)
+
+    def generation(self) -> int:
+        return self._generation
+
+    def put(
+        self, query: str, role: str, df: pd.DataFrame, generation: int | None = None
+    ) -> None:
+        """
+        Stores the result of a query. Pass the value of generation() taken
+        before running the query: if a write invalidated the cache while the
+        query was running, the result may be stale and is not stored.
+        A result that can't be stored (e.g. a column type Arrow doesn't support)
+        is skipped: the cache is an optimization, it never makes the query fail.
+        """
+        normalized_query = normalize_sql(query)
+        try:
+            data = write_dataframe_to_bytes(df, ARROW_STREAM_MEDIA_TYPE)
+        except Exception as e:
+            logging.warning(f"Query result not cached, it can't be serialized: {e}")
+            return
+        if len(data) > self.max_bytes:
+            return
+        key = (normalized_query, role)
+        tables = referenced_tables(normalized_query)
+        entry = (
+            time.monotonic() + self.ttl_seconds,
+            None if tables is None else frozenset(tables),
+            data,
+        )
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size_bytes += len(data)
+            while self._size_bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate_query(self, query: str) -> None:
+        """Drops the entries reading any table modified by a write query"""
+        self.invalidate_tables(referenced_tables(normalize_sql(query)))
+
+    def invalidate_tables(self, tables: set[str] | None) -> None:
+        with self._lock:
+            self._generation += 1
+            if not tables:
+                # We could not tell which tables were modified, so
+                # nothing in the cache can be trusted
+                self._entries.clear()
+                self._size_bytes = 0
+                return
+            # Entries whose tables are unknown may read any table
+            stale_keys = [
+                key
+                for key, entry in self._entries.items()
+                if entry[1] is None or entry[1] & tables
+            ]
+            for key in stale_keys:
+                self._remove(key)
+
+    def _remove(self, key: tuple[str, str]) -> None:
+        _, _, data = self._entries.pop(key)
+        self._size_bytes -= len(data)
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Normalizes a query so that queries that only differ by spacing,
+    case of keywords or a final ";" share the same key.
+    Quoted strings (including dollar-quoted ones) and identifiers are left untouched.
+    """
+    query = query.strip().rstrip(";").strip()
+    parts = []
+    position = 0
+    for quoted in _QUOTED_PARTS.finditer(query):
+        parts.append(_normalize_unquoted(query[position : quoted.start()]))
+        parts.append(quoted.group())
+        position = quoted.end()
+    parts.append(_normalize_unquoted(query[position:]))
+    return "".join(parts)
+
+
+def _normalize_unquoted(part: str) -> str:
+    return re.sub(r"\s+", " ", part).lower()
+
+
+def referenced_tables(normalized_query: str) -> set[str] | None:
+    """
+    Names of the tables a normalized query reads or writes (without schema, unquoted).
+    This is not a full SQL parser: it returns None when it can't tell,
+    and callers must then assume that the query may touch any table.
+    """
+    tokens = [token.group() for token in _TOKEN.finditer(normalized_query)]
+    return _referenced_tables(tokens)
+
+
+def _referenced_tables(tokens: list[str]) -> set[str] | None:
+    tables = set()
+    in_function_call = _in_function_call(tokens)
+    i = 0
+    while i < len(tokens):
+        keyword = tokens[i]
+        i += 1
+        # FROM can be part of the syntax of a function ("extract(year from ts)")
+        if keyword not in _TABLE_KEYWORDS or in_function_call[i - 1]:
+            continue
+        while True:
+            while i < len(tokens) and tokens[i] in _TABLE_MODIFIERS:
+                i += 1
+            if i < len(tokens) and tokens[i] == "(":
+                end = _skip_parentheses(tokens, i)
+                subquery_tables = _referenced_tables(tokens[i + 1 : end - 1])
+                if subquery_tables is None:
+                    return None
+                tables |= subquery_tables
+                i = end
+            else:
+                table, i = _parse_table_name(tokens, i)
+                if table is None:
+                    return None
+                tables.add(table)
+            # Only some clauses list several tables separated by
+            # commas ("from a x, b y", "truncate a, b")
+            if keyword not in _TABLE_LIST_KEYWORDS:
+                break
+            i = _skip_alias(tokens, i)
+            if i >= len(tokens) or tokens[i] != ",":
+                break
+            i += 1
+    return tables or None
+
+
+def _parse_table_name(tokens: list[str], i: int) -> tuple[str | None, int]:
+    """Reads a table name, possibly qualified by a schema, starting at tokens[i]"""
+    if i >= len(tokens) or not _is_identifier(tokens[i]):
+        return None, i
+    name = tokens[i]
+    i += 1
+    while i + 1 < len(tokens) and tokens[i] == "." and _is_identifier(tokens[i + 1]):
+        name = tokens[i + 1]
+        i += 2
+    return name.strip('"').replace('""', '"'), i
+
+
+def _skip_alias(tokens: list[str], i: int) -> int:
+    if i < len(tokens) and tokens[i] == "as":
+        i += 1
+    if (
+        i < len(tokens)
+        and _is_identifier(tokens[i])
+        and tokens[i] not in _CLAUSE_KEYWORDS
+    ):
+        i += 1
+        if i < len(tokens) and tokens[i] == "(":
+            i = _skip_parentheses(tokens, i)  # column aliases: "from t as x(a, b)"
+    return i
+
+
+def _in_function_call(tokens: list[str]) -> list[bool]:
+    """
+    For each token, whether it is directly within the parentheses of the arguments
+    of a function call, rather than in a subquery ("exists (select ...)",
+    "array(select ...)", "as (delete ...)") or at the top level
+    """
+    result = []
+    # For each parenthesis opened so far, whether it holds the arguments of a function
+    stack: list[bool] = []
+    for i, token in enumerate(tokens):
+        if token == "(":
+            stack.append(
+                i > 0
+                and _is_identifier(tokens[i - 1])
+                and tokens[i - 1] not in _TABLE_KEYWORDS
+                and (i + 1 == len(tokens) or tokens[i + 1] not in _QUERY_KEYWORDS)
+            )
+        elif token == ")" and stack:
+            stack.pop()
+        result.append(bool(stack) and stack[-1])
+    return result
+
+
+def _skip_parentheses(tokens: list[str], i: int) -> int:
+    """Index of the token after the parenthesis closing the one at tokens[i]"""
+    depth = 0
+    while i < len(tokens):
+        if tokens[i] == "(":
+            depth += 1
+        elif tokens[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+def _is_identifier(token: str) -> bool:
+    return token.startswith('"') or (token[0].isalpha() or token[0] == "_")
+
+
+# The cache shared by the whole process
+query_result_cache = QueryResultCache(
+    ttl_seconds=float(os.getenv("DSBA_QUERY_CACHE_TTL_SECONDS", "60")),
+    max_bytes=int(os.getenv("DSBA_QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+)
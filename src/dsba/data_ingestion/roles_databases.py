@@ -8,6 +8,7 @@ from dataclasses import dataclass
 import supabase
 from psycopg2 import sql
 import pandas as pd
+from dsba.data_ingestion.query_cache import query_result_cache
 
 # Load environment variables from .env file
 load_dotenv(".env")
@@ -139,6 +140,7 @@ def register_new_user(email: str, password: str):
                 
                 cursor.execute(roles_query, [user_id, default_role])
                 conn.commit()
+                query_result_cache.invalidate_tables({"roles"})
                 
                 return user_id, f"New user registered with {default_role} role. Please check your email to confirm your account."
             except Exception as db_error:
@@ -191,6 +193,7 @@ def add_or_update_user(config: PostgresConfig, user_id: str, role: str, requeste
             cursor.execute(insert_query, [user_id, role])
         
         conn.commit()
+        query_result_cache.invalidate_tables({"roles"})
         return f"User {user_id} assigned role: {role}"
         
     except Exception as e:
@@ -202,8 +205,15 @@ def add_or_update_user(config: PostgresConfig, user_id: str, role: str, requeste
             conn.close()
 
 
-def perform_query(config: PostgresConfig, query: str, user_role: str):
-    """Perform a query on the database based on user role and return the result as a pandas DataFrame."""
+def perform_query(  # noqa: PLR0911  (one return per access or cache outcome)
+    config: PostgresConfig, query: str, user_role: str, use_cache: bool = False
+):
+    """
+    Perform a query on the database based on user role and return the result as a pandas DataFrame.
+    With use_cache=True, the result of a SELECT query may come from the query result
+    cache (see query_cache.py), for queries repeated often like dashboards.
+    Writes always go to the database and invalidate the cache.
+    """
     
     # Handle unauthorized users
     if user_role == "unauthorized":
@@ -213,6 +223,13 @@ def perform_query(config: PostgresConfig, query: str, user_role: str):
     if user_role == "read_access" and any(op in query.upper() for op in ['INSERT', 'UPDATE', 'DELETE', 'DROP', 'CREATE', 'ALTER']):
         return "Access denied: Read-only role cannot modify data"
     
+    is_select = query.upper().startswith('SELECT')
+    if use_cache and is_select:
+        cached_df = query_result_cache.get(query, user_role)
+        if cached_df is not None:
+            return cached_df
+        cache_generation = query_result_cache.generation()
+
     conn = None
     try:
         # Connect to PostgreSQL using pooler as backup
@@ -228,7 +245,7 @@ def perform_query(config: PostgresConfig, query: str, user_role: str):
         cursor = conn.cursor()
 
         # Check if the query is a SELECT query
-        if query.upper().startswith('SELECT'):
+        if is_select:
             # Execute the SELECT query
             cursor.execute(query)
 
@@ -241,12 +258,16 @@ def perform_query(config: PostgresConfig, query: str, user_role: str):
             # Convert the result into a pandas DataFrame
             df = pd.DataFrame(result, columns=columns)
 
+            if use_cache:
+                query_result_cache.put(query, user_role, df, cache_generation)
+
             return df  # Return the DataFrame
 
         else:
             # For non-SELECT queries (INSERT, UPDATE, DELETE), execute without fetching
             cursor.execute(query)
             conn.commit()  # Commit the transaction for changes
+            query_result_cache.invalidate_query(query)
 
             return "Query executed successfully"  # Return success message for write operations
 
@@ -383,7 +404,7 @@ if __name__ == "__main__":
                 
             print("\n--- List All User Roles ---")
             query = "SELECT user_id, role FROM roles;"
-            result = perform_query(config, query, role)
+            result = perform_query(config, query, role, use_cache=True)
             if isinstance(result, pd.DataFrame):
                 print(f"Users and roles:\n{result}")
             else:
@@ -0,0 +1,252 @@
+"""
+Writing of large DataFrames (e.g. scored datasets) to CSV or
+Parquet, fast and without ever exposing partial files.
+
+Data is written by chunks:
+- to a single file: CSV chunks are encoded (and compressed) in
+  parallel by a thread pool and appended in order.
+  A gzip or zstd file made of several compressed pieces one after
+  the other is still a valid file.
+  Parquet chunks become the row groups of the file.
+- or, with partitioned=True, to a directory with one file per chunk
+  (part-00000.csv.gz, part-00001.csv.gz...)
+  written in parallel.
+
+CSV is formatted by pandas (DataFrame.to_csv), so files are exactly the
+same as before this module existed (quoting only when needed, True/False,
+pandas' timestamp and float formats) and existing consumers keep working.
+Compression and Parquet encoding are done by pyarrow, which releases
+the GIL, so most of the work of the threads runs in parallel.
+Everything is written to a temporary path next to the destination,
+renamed to the destination once complete:
+readers either see the previous output or the complete new one.
+"""
+
+import os
+import shutil
+import uuid
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FORMATS = ("csv", "parquet")
+COMPRESSIONS = ("gzip", "zstd")
+_COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+class DatasetWriter:
+    """
+    Writes a dataset chunk by chunk. Use it as a context manager:
+    the output is published when the block exits normally, and the
+    temporary files are removed if it raises.
+
+        with DatasetWriter("scored.csv.gz", compression="gzip") as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        format: str = "csv",
+        compression: str | None = None,
+        partitioned: bool = False,
+        max_workers: int | None = None,
+    ):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown format: {format}, expected one of {FORMATS}")
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression: {compression}, expected one of {COMPRESSIONS}"
+            )
+        self.path = Path(path)
+        self.format = format
+        self.compression = compression
+        self.partitioned = partitioned
+        self.rows = 0
+        self._tmp_path = self.path.with_name(
+            f".{self.path.name}.tmp-{uuid.uuid4().hex}"
+        )
+        max_workers = max_workers or min(8, os.cpu_count() or 1)
+        self._executor = ThreadPoolExecutor(max_workers)
+        # Bounded so that chunks don't pile up in memory if the disk
+        # is slower than the caller
+        self._max_pending = 2 * max_workers
+        self._pending: deque[Future] = deque()
+        self._chunks = 0
+        self._file = None
+        self._parquet_writer: pq.ParquetWriter | None = None
+        self._schema: pa.Schema | None = None
+        if partitioned:
+            self._tmp_path.mkdir(parents=True)
+        elif format == "csv":
+            self._file = open(self._tmp_path, "wb")
+
+    def write(self, df: pd.DataFrame) -> None:
+        if self.format == "csv":
+            # Encoded later by a thread: a copy, so that the caller
+            # can modify or reuse its DataFrame
+            data = df.copy()
+        else:
+            data = pa.Table.from_pandas(df, preserve_index=False)
+        if self.partitioned:
+            part_path = self._tmp_path / f"part-{self._chunks:05d}{self._extension()}"
+            self._submit(self._write_part, data, part_path)
+        elif self.format == "csv":
+            self._submit(_encode_csv, data, self._chunks == 0, self.compression)
+        else:
+            self._write_row_group(data)
+        self._chunks += 1
+        self.rows += len(df)
+
+    def close(self) -> None:
+        """Waits for the pending chunks, then publishes the output at its destination"""
+        try:
+            while self._pending:
+                self._finish_oldest()
+            if self._file is not None:
+                self._file.close()
+            if self._parquet_writer is not None:
+                self._parquet_writer.close()
+            elif self.format == "parquet" and not self.partitioned:
+                raise ValueError(f"No data was written to {self.path}")
+        except BaseException:
+            self.abort()
+            raise
+        self._executor.shutdown()
+        self._publish()
+
+    def abort(self) -> None:
+        """Drops everything written so far, the destination is left untouched"""
+        for future in self._pending:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        self._pending.clear()
+        if self._file is not None:
+            self._file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        if self._tmp_path.is_dir():
+            shutil.rmtree(self._tmp_path, ignore_errors=True)
+        else:
+            self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "DatasetWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _submit(self, func, *args) -> None:
+        self._pending.append(self._executor.submit(func, *args))
+        while len(self._pending) > self._max_pending:
+            self._finish_oldest()
+
+    def _finish_oldest(self) -> None:
+        # Futures are finished in submission order, so CSV chunks are
+        # appended in the order they were written
+        result = self._pending.popleft().result()
+        if self._file is not None:
+            self._file.write(result)
+
+    def _write_part(self, data: pa.Table | pd.DataFrame, path: Path) -> None:
+        if self.format == "parquet":
+            pq.write_table(data, path, compression=self.compression or "snappy")
+            return
+        with _open_output_stream(path, self.compression) as stream:
+            stream.write(data.to_csv(index=False).encode())
+
+    def _write_row_group(self, table: pa.Table) -> None:
+        if self._parquet_writer is None:
+            self._schema = table.schema
+            self._parquet_writer = pq.ParquetWriter(
+                self._tmp_path, self._schema, compression=self.compression or "snappy"
+            )
+        else:
+            # e.g. a column that is entirely null in the first chunk
+            # but not in the next ones
+            table = table.cast(self._schema)
+        self._parquet_writer.write_table(table)
+
+    def _extension(self) -> str:
+        return f".{self.format}" + (
+            _COMPRESSION_EXTENSIONS[self.compression]
+            if self.format == "csv" and self.compression
+            else ""
+        )
+
+    def _publish(self) -> None:
+        if not self.partitioned or not self.path.exists():
+            os.replace(self._tmp_path, self.path)
+            return
+        # A directory can't atomically replace a non-empty one: the
+        # previous output is moved away first, so the destination is
+        # missing for a very short time, but is never partial
+        old_path = self.path.with_name(f".{self.path.name}.old-{uuid.uuid4().hex}")
+        os.replace(self.path, old_path)
+        os.replace(self._tmp_path, self.path)
+        if old_path.is_dir():
+            shutil.rmtree(old_path, ignore_errors=True)
+        else:
+            old_path.unlink()
+
+
+def write_dataframe(  # noqa: PLR0913, PLR0917  (options of DatasetWriter)
+    df: pd.DataFrame,
+    path: str | Path,
+    format: str | None = None,
+    compression: str | None = None,
+    chunksize: int = 100_000,
+    partitioned: bool = False,
+    max_workers: int | None = None,
+) -> None:
+    """
+    Writes a DataFrame with a DatasetWriter, by chunks of `chunksize` rows.
+    When not given, the format and the compression are deduced from the file name
+    (e.g. "scored.parquet", "scored.csv.gz", "scored.csv.zst").
+    """
+    if format is None:
+        format = infer_format(path)
+    if compression is None and format == "csv":
+        compression = infer_compression(path)
+    with DatasetWriter(path, format, compression, partitioned, max_workers) as writer:
+        # At least one chunk, so that an empty DataFrame still gets its CSV header
+        for start in range(0, max(len(df), 1), chunksize):
+            writer.write(df.iloc[start : start + chunksize])
+
+
+def infer_format(path: str | Path) -> str:
+    return "parquet" if ".parquet" in Path(path).suffixes else "csv"
+
+
+def infer_compression(path: str | Path) -> str | None:
+    suffix = Path(path).suffix
+    for compression, extension in _COMPRESSION_EXTENSIONS.items():
+        if suffix == extension:
+            return compression
+    return None
+
+
+def _encode_csv(
+    df: pd.DataFrame, include_header: bool, compression: str | None
+) -> pa.Buffer:
+    sink = pa.BufferOutputStream()
+    stream = pa.CompressedOutputStream(sink, compression) if compression else sink
+    stream.write(df.to_csv(index=False, header=include_header).encode())
+    if compression:
+        # Closing the compressed stream writes the end of the compressed piece
+        stream.close()
+    return sink.getvalue()
+
+
+def _open_output_stream(path: Path, compression: str | None) -> pa.NativeFile:
+    if compression:
+        return pa.CompressedOutputStream(str(path), compression)
+    return pa.OSFile(str(path), "wb")
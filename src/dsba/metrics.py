@@ -0,0 +1,260 @@
+"""
+A very small in-process metrics library: counters and latency histograms,
+exposed in the Prometheus text format so they can be scraped from a "/metrics" endpoint.
+
+Libraries such as prometheus_client do this (and much more), but
+what we need fits in a few lines, and writing it ourselves keeps the
+hot path cheap: recording a value is a dictionary lookup, a binary
+search in the bucket boundaries and an addition under a lock.
+All the formatting work only happens when someone actually scrapes the endpoint.
+"""
+
+import bisect
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+# Bucket upper bounds in seconds, from half a millisecond (parsing
+# a small JSON) to 10 seconds (loading a big model)
+DEFAULT_LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class Counter:
+    """A monotonically increasing value, one per combination of label values."""
+
+    def __init__(self, name: str, help_text: str, label_names: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(_label_values(self.label_names, labels), 0.0)
+
+    def snapshot(self) -> list:
+        """
+        The values of all the series, in a JSON serializable form
+        that collect() can merge
+        """
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def collect(self, other_snapshots: list[list] = ()) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for snapshot in other_snapshots:
+            for key, value in snapshot:
+                values[tuple(key)] = values.get(tuple(key), 0.0) + value
+        for key, value in values.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Counts observations into buckets (plus their sum and count), one
+    series per combination of label values.
+    We store per-bucket counts and only compute the cumulative
+    counts Prometheus expects when rendering.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # For each series: [count per bucket (+1 for the "+Inf"
+        # bucket)..., sum of observations]
+        self._series: dict[tuple[str, ...], list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = _label_values(self.label_names, labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = [0.0] * (len(self.buckets) + 2)
+                self._series[key] = series
+            series[bucket_index] += 1
+            series[-1] += value
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(_label_values(self.label_names, labels))
+        return 0 if series is None else int(sum(series[:-1]))
+
+    def snapshot(self) -> list:
+        """
+        The values of all the series, in a JSON serializable form
+        that collect() can merge
+        """
+        with self._lock:
+            return [[list(key), list(series)] for key, series in self._series.items()]
+
+    def collect(self, other_snapshots: list[list] = ()) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            all_series = {key: list(series) for key, series in self._series.items()}
+        for snapshot in other_snapshots:
+            for key, other_series in snapshot:
+                series = all_series.setdefault(tuple(key), [0.0] * len(other_series))
+                for i, value in enumerate(other_series):
+                    series[i] += value
+        for key, series in all_series.items():
+            cumulative = 0.0
+            bounds = [*(str(bound) for bound in self.buckets), "+Inf"]
+            for bound, bucket_count in zip(bounds, series[:-1], strict=True):
+                cumulative += bucket_count
+                labels = _format_labels((*self.label_names, "le"), (*key, bound))
+                lines.append(f"{self.name}_bucket{labels} {int(cumulative)}")
+            labels = _format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {series[-1]}")
+            lines.append(f"{self.name}_count{labels} {int(cumulative)}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds all the metrics of a process so they can be rendered together."""
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+        self._lock = threading.Lock()
+
+    def counter(
+        self, name: str, help_text: str, label_names: tuple[str, ...] = ()
+    ) -> Counter:
+        return self._register(name, lambda: Counter(name, help_text, label_names))
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        label_names: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            name, lambda: Histogram(name, help_text, label_names, buckets)
+        )
+
+    def snapshot(self) -> dict[str, list]:
+        """
+        The values of all the metrics, e.g. to be merged with the
+        ones of other processes
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics}
+
+    def render(self, other_snapshots: list[dict[str, list]] = ()) -> str:
+        """
+        Renders all the metrics in the Prometheus text exposition format.
+        The snapshots of other processes (e.g. the other workers of
+        the API) are added to the values of this one.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(
+                metric.collect(
+                    [s[metric.name] for s in other_snapshots if metric.name in s]
+                )
+            )
+        return "\n".join(lines) + "\n"
+
+    def _register(self, name, factory):
+        # Registering twice the same name returns the existing metric,
+        # so modules can declare their metrics at import time without
+        # worrying about reloads
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = factory()
+            return self._metrics[name]
+
+
+# The default registry of the process, most code should just use this one
+REGISTRY = MetricsRegistry()
+
+
+class StageTimer:
+    """
+    Measures the duration of the successive stages of a request.
+    Durations are only kept locally while the request runs, and recorded in histograms
+    at the end, once we know the outcome of the request (which is one of the labels).
+    """
+
+    def __init__(self):
+        self.durations: list[tuple[str, float]] = []
+        self._start = time.perf_counter()
+
+    @contextmanager
+    def time(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations.append((stage, time.perf_counter() - start))
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def record(
+        self, stage_histogram: Histogram, request_histogram: Histogram, **labels: str
+    ) -> None:
+        for stage, duration in self.durations:
+            stage_histogram.observe(duration, stage=stage, **labels)
+        request_histogram.observe(self.elapsed(), **labels)
+
+
+def _label_values(
+    label_names: tuple[str, ...], labels: dict[str, str]
+) -> tuple[str, ...]:
+    if len(labels) != len(label_names):
+        raise ValueError(f"Expected labels {label_names}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in label_names)
+
+
+def _format_labels(label_names: tuple[str, ...], label_values: tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+    pairs = ",".join(
+        f'{name}="{_escape_label_value(value)}"'
+        for name, value in zip(label_names, label_values, strict=True)
+    )
+    return "{" + pairs + "}"
+
+
+def _escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
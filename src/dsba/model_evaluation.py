@@ -25,9 +25,19 @@ class ClassifierEvaluationResult:
 
 
 def evaluate_classifier(
-    classifier: ClassifierMixin, target_column: str, df: pd.DataFrame
+    classifier: ClassifierMixin,
+    target_column: str,
+    df: pd.DataFrame,
+    categories: dict[str, list] | None,
 ) -> ClassifierEvaluationResult:
-    df = preprocess_dataframe(df)
+    """
+    categories: the categories stored in the metadata of the
+    classifier (metadata.categories), None only for models saved
+    before they were stored.
+    It is required: evaluating a model with other codes than the
+    ones it was trained with would give wrong metrics.
+    """
+    df = preprocess_dataframe(df, categories)
     X, y_actual = split_features_and_target(df, target_column)
     y_predicted = classifier.predict(X)
 
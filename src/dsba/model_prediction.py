@@ -1,31 +1,169 @@
 import logging
+from concurrent.futures import Executor
 import pandas as pd
 from sklearn.base import ClassifierMixin
+from dsba.metrics import StageTimer
+from dsba.model_registry import ClassifierMetadata, get_model_version_dir
+from dsba.monitoring import FeatureMonitor
 from dsba.preprocessing import preprocess_dataframe
+from dsba.tree_engine import load_or_compile
 
 
-# TODO: Instead of using all the classifiers by default, add commands to allow the user to choose his model, 
+# TODO: Instead of using all the classifiers by default, add commands to allow the user to choose his model,
 # whether it is classifier or regressor
 
-def classify_dataframe(
-    model: ClassifierMixin, df: pd.DataFrame, target_column: str
+
+def classify_dataframe(  # noqa: PLR0913, PLR0917  (optional hooks of the scoring, passed along)
+    model: ClassifierMixin,
+    df: pd.DataFrame,
+    target_column: str,
+    monitor: FeatureMonitor | None = None,
+    timer: StageTimer | None = None,
+    categories: dict[str, list] | None = None,
 ) -> pd.DataFrame:
+    """
+    Predicts the target column of every row of the DataFrame.
+    categories are the categories stored in the metadata of the
+    model (see preprocessing.fit_categories).
+    If a timer is given, the durations of the "preprocess" and
+    "predict" stages are added to it.
+    Returns the rows as they were given, with the predictions in the target column.
+    """
+    # A throwaway timer when none is given, so that the code below doesn't need to check
+    timer = timer or StageTimer()
     _check_target_column(df, target_column)
-    df = preprocess_dataframe(df)
-    y_predicted = model.predict(df)
-    df[target_column] = y_predicted
-    return df
+    if monitor is not None:
+        # The monitor looks at the raw features, before preprocessing modifies them
+        monitor.observe(df)
+    with timer.time("preprocess"):
+        # Preprocessing replaces the columns of the frame it is given (encoded
+        # categories, float32...), a shallow copy keeps the input values intact
+        features = preprocess_dataframe(df.copy(deep=False), categories)
+    with timer.time("predict"):
+        y_predicted = model.predict(features)
+    return df.assign(**{target_column: y_predicted})
 
 
-def classify_record(
-    model: ClassifierMixin, record: dict, target_column: str
+def classify_record(  # noqa: PLR0913, PLR0917  (optional hooks of the scoring, passed along)
+    model: ClassifierMixin,
+    record: dict,
+    target_column: str,
+    monitor: FeatureMonitor | None = None,
+    timer: StageTimer | None = None,
+    categories: dict[str, list] | None = None,
 ) -> int | float | str:
     df = pd.DataFrame([record])
     _check_target_column(df, target_column)
-    df = classify_dataframe(model, df, target_column)
+    df = classify_dataframe(model, df, target_column, monitor, timer, categories)
     return df.iloc[0][target_column]
 
 
+def classify_records(  # noqa: PLR0913, PLR0917  (optional hooks of the scoring, passed along)
+    model: ClassifierMixin,
+    records: list[dict],
+    target_column: str,
+    monitor: FeatureMonitor | None = None,
+    timer: StageTimer | None = None,
+    categories: dict[str, list] | None = None,
+) -> list[int | float | str]:
+    df = pd.DataFrame(records)
+    df = classify_dataframe(model, df, target_column, monitor, timer, categories)
+    return df[target_column].tolist()
+
+
+def classify_dataframe_multi(  # noqa: PLR0913, PLR0917  (optional hooks of the scoring, passed along)
+    models: dict[str, ClassifierMixin],
+    df: pd.DataFrame,
+    target_columns: list[str],
+    executor: Executor | None = None,
+    categories: dict[str, dict[str, list] | None] | None = None,
+    timer: StageTimer | None = None,
+) -> dict[str, list[int | float | str]]:
+    """
+    Scores the same DataFrame with several models
+    (e.g. to compare a candidate model with the production one).
+    categories gives the categories of each model by model id
+    (see preprocessing.fit_categories).
+    The DataFrame is preprocessed only once for all the models sharing the
+    same categories (usually all of them, when they were trained on the same
+    data), then the models predict concurrently if an executor is given
+    (XGBoost releases the GIL while predicting, so threads are enough).
+    Returns the predictions of each model, by model id.
+    """
+    timer = timer or StageTimer()
+    categories = categories or {}
+    # Groups of model ids sharing the same categories
+    groups: list[tuple[dict[str, list] | None, list[str]]] = []
+    for model_id in models:
+        model_categories = categories.get(model_id)
+        for group_categories, model_ids in groups:
+            if (
+                group_categories is model_categories
+                or group_categories == model_categories
+            ):
+                model_ids.append(model_id)
+                break
+        else:
+            groups.append((model_categories, [model_id]))
+
+    predictions = {}
+    for i, (group_categories, model_ids) in enumerate(groups):
+        # Preprocessing modifies the DataFrame, only the last group can use the original
+        group_df = df if i == len(groups) - 1 else df.copy()
+        with timer.time("preprocess"):
+            features = prepare_features(group_df, target_columns, group_categories)
+        with timer.time("predict"):
+            group_models = {model_id: models[model_id] for model_id in model_ids}
+            predictions.update(predict_with_models(group_models, features, executor))
+    return predictions
+
+
+def prepare_features(
+    df: pd.DataFrame,
+    target_columns: list[str],
+    categories: dict[str, list] | None = None,
+) -> pd.DataFrame:
+    for target_column in set(target_columns):
+        _check_target_column(df, target_column)
+    return preprocess_dataframe(df, categories)
+
+
+def predict_with_models(
+    models: dict[str, ClassifierMixin],
+    features: pd.DataFrame,
+    executor: Executor | None = None,
+) -> dict[str, list[int | float | str]]:
+    """Predicts with several models on already preprocessed features"""
+    if executor is None or len(models) <= 1:
+        return {
+            model_id: model.predict(features).tolist()
+            for model_id, model in models.items()
+        }
+    futures = {
+        model_id: executor.submit(model.predict, features)
+        for model_id, model in models.items()
+    }
+    return {model_id: future.result().tolist() for model_id, future in futures.items()}
+
+
+def select_inference_engine(
+    model: ClassifierMixin, metadata: ClassifierMetadata, version: str
+) -> ClassifierMixin:
+    """
+    Returns the object that should compute the predictions of a model, according to
+    its metadata.
+    With inference_engine="compiled", XGBoost models are replaced by their compiled
+    form (see dsba.tree_engine), which has the same predict method and is much faster
+    on small inputs.
+    The compiled form is cached in the registry next to the model.
+    """
+    if metadata.inference_engine == "native":
+        return model
+    if metadata.inference_engine == "compiled":
+        return load_or_compile(model, get_model_version_dir(metadata.id, version))
+    raise ValueError(f"Unknown inference engine: {metadata.inference_engine}")
+
+
 def _check_target_column(df: pd.DataFrame, target_column: str) -> None:
     """
     As a convenience, we allow the user to pass a dataframe that already has the target column in the input
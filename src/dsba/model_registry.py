@@ -2,11 +2,36 @@ import joblib
 import json
 import logging
 import os
+import shutil
+import uuid
+from collections.abc import Callable
 from dataclasses import dataclass, asdict
+from datetime import datetime
 from pathlib import Path
 from typing import Any
 from sklearn.base import BaseEstimator
 
+# Each model id has its own directory, with one immutable sub-directory per saved
+# version and a small "ACTIVE" file that contains the version currently served:
+#
+#   <DSBA_MODELS_ROOT_PATH>/<model_id>/ACTIVE
+#   <DSBA_MODELS_ROOT_PATH>/<model_id>/versions/<version>/model.pkl
+#   <DSBA_MODELS_ROOT_PATH>/<model_id>/versions/<version>/metadata.json
+#
+# A version is never modified once written, and it only becomes visible once complete:
+# files are written in a temporary directory which is then renamed
+# (a rename is atomic on the same filesystem).
+# Publishing a version is also a rename, of a new "ACTIVE" file over the old one.
+# So a reader either sees the previous version or the new one,
+# never a half-written pickle or mismatched metadata.
+#
+# Models saved before versioning existed (<model_id>.pkl and
+# <model_id>.json at the root) can still be loaded.
+ACTIVE_VERSION_FILE = "ACTIVE"
+VERSIONS_DIR = "versions"
+MODEL_FILE = "model.pkl"
+METADATA_FILE = "metadata.json"
+
 
 @dataclass
 class ClassifierMetadata:
@@ -17,31 +42,139 @@ class ClassifierMetadata:
     target_column: str
     description: str
     performance_metrics: dict[str, float]
+    # Summary of the training data used to detect drift (see dsba.monitoring).
+    # It has a default value so that metadata saved before this
+    # field existed can still be loaded.
+    feature_baseline: dict[str, Any] | None = None
+    # How predictions are computed: "native" (the model's own
+    # predict) or "compiled" (see dsba.tree_engine)
+    inference_engine: str = "native"
+    # Categories of the non-numeric columns seen at training time (see
+    # preprocessing.fit_categories), None for models saved before they were stored
+    categories: dict[str, list] | None = None
+
+
+def save_model(model: BaseEstimator, metadata: ClassifierMetadata) -> str:
+    """
+    Saves the model as a new version and makes it the active version of this model id.
+    Returns the new version.
+    """
+    version = _new_version()
+    versions_dir = _get_model_dir(metadata.id) / VERSIONS_DIR
+    versions_dir.mkdir(parents=True, exist_ok=True)
+    tmp_version_dir = versions_dir / f".tmp-{version}"
+    tmp_version_dir.mkdir()
+    logging.info(f"Save model {metadata.id} version {version} to path: {versions_dir}")
+    try:
+        joblib.dump(model, tmp_version_dir / MODEL_FILE)
+        _write_file_durably(
+            tmp_version_dir / METADATA_FILE, json.dumps(asdict(metadata))
+        )
+        _fsync_path(tmp_version_dir / MODEL_FILE)
+        os.rename(tmp_version_dir, versions_dir / version)
+    except BaseException:
+        # e.g. a model that can't be pickled or a full disk: nothing
+        # was published, nothing should be left behind
+        shutil.rmtree(tmp_version_dir, ignore_errors=True)
+        raise
+    activate_model_version(metadata.id, version)
+    return version
+
+
+def activate_model_version(model_id: str, version: str) -> None:
+    """Makes an existing version the one served for the model id, e.g. to roll back"""
+    if not (_get_version_dir(model_id, version) / MODEL_FILE).exists():
+        raise FileNotFoundError(f"Model {model_id} has no version {version}")
+    model_dir = _get_model_dir(model_id)
+    tmp_pointer_path = model_dir / f".{ACTIVE_VERSION_FILE}.tmp-{uuid.uuid4().hex}"
+    _write_file_durably(tmp_pointer_path, version)
+    os.replace(tmp_pointer_path, model_dir / ACTIVE_VERSION_FILE)
+    for listener in _model_saved_listeners:
+        listener(model_id)
+
+
+# Functions called with the model id every time a model version is
+# published by this process.
+# Caches of things derived from a model use it to drop their stale entries right away.
+_model_saved_listeners: list[Callable[[str], None]] = []
 
 
-def save_model(model: BaseEstimator, metadata: ClassifierMetadata) -> None:
-    model_path = _get_model_path(metadata.id)
-    model_metadata_path = _get_model_metadata_path(metadata.id)
-    logging.info("Save model to path: " + str(model_path))
-    joblib.dump(model, model_path)
-    with open(model_metadata_path, "w") as f:
-        json.dump(asdict(metadata), f)
+def add_model_saved_listener(listener: Callable[[str], None]) -> None:
+    _model_saved_listeners.append(listener)
 
 
 def list_models_ids() -> list[str]:
     models_dir = _get_models_dir()
-    model_files = _list_pickle_files(models_dir)
-    models_ids = [_remove_file_extension(model) for model in model_files]
-    return models_ids
+    versioned_ids = [
+        entry.name
+        for entry in models_dir.iterdir()
+        if (entry / ACTIVE_VERSION_FILE).exists()
+    ]
+    legacy_ids = [
+        _remove_file_extension(model) for model in _list_pickle_files(models_dir)
+    ]
+    return sorted(set(versioned_ids + legacy_ids))
+
+
+def list_model_versions(model_id: str) -> list[str]:
+    versions_dir = _get_model_dir(model_id) / VERSIONS_DIR
+    if not versions_dir.exists():
+        return []
+    # Versions start with a timestamp, so sorting them by name sorts them by date
+    return sorted(p.name for p in versions_dir.iterdir() if not p.name.startswith("."))
+
+
+def get_model_version(model_id: str) -> str:
+    """
+    Returns the active version of a model.
+    It only reads a tiny file, so it is cheap enough to be checked
+    often to detect new versions.
+    """
+    pointer_path = _get_model_dir(model_id) / ACTIVE_VERSION_FILE
+    try:
+        return pointer_path.read_text().strip()
+    except FileNotFoundError:
+        # Model saved before versioning: the version is derived from
+        # the pickle file itself
+        stat = _get_model_path(model_id).stat()
+        return f"legacy-{stat.st_mtime_ns}-{stat.st_size}"
+
+
+def load_model(model_id, version: str | None = None) -> BaseEstimator:
+    model, _ = load_model_and_metadata(model_id, version)
+    return model
+
 
+def load_model_metadata(model_id, version: str | None = None) -> ClassifierMetadata:
+    version = version or get_model_version(model_id)
+    return _read_metadata(_get_version_files(model_id, version)[1])
 
-def load_model(model_id) -> BaseEstimator:
-    model_path = _get_model_path(model_id)
-    return _load_model_from_path(model_path)
+
+def load_model_and_metadata(
+    model_id: str, version: str | None = None
+) -> tuple[BaseEstimator, ClassifierMetadata]:
+    """
+    Loads a model and its metadata from the same version.
+    Prefer this over load_model followed by load_model_metadata,
+    which could otherwise see two different versions if one is published in between.
+    """
+    version = version or get_model_version(model_id)
+    model_path, metadata_path = _get_version_files(model_id, version)
+    return _load_model_from_path(model_path), _read_metadata(metadata_path)
+
+
+def get_model_version_dir(model_id: str, version: str) -> Path | None:
+    """
+    Directory holding the files of a version, where files derived
+    from the model can be cached.
+    Legacy models have no such directory.
+    """
+    if version.startswith("legacy-"):
+        return None
+    return _get_version_dir(model_id, version)
 
 
-def load_model_metadata(model_id) -> ClassifierMetadata:
-    metadata_path = _get_model_metadata_path(model_id)
+def _read_metadata(metadata_path: Path) -> ClassifierMetadata:
     with open(metadata_path, "r") as f:
         metadata_as_dict = json.load(f)
     metadata = ClassifierMetadata(**metadata_as_dict)
@@ -57,6 +190,21 @@ def _load_model_from_path(path: str | Path) -> BaseEstimator:
     return joblib.load(path)
 
 
+def _get_version_files(model_id: str, version: str) -> tuple[Path, Path]:
+    if version.startswith("legacy-"):
+        return _get_model_path(model_id), _get_model_metadata_path(model_id)
+    version_dir = _get_version_dir(model_id, version)
+    return version_dir / MODEL_FILE, version_dir / METADATA_FILE
+
+
+def _get_version_dir(model_id: str, version: str) -> Path:
+    return _get_model_dir(model_id) / VERSIONS_DIR / version
+
+
+def _get_model_dir(model_id: str) -> Path:
+    return Path(os.path.join(_get_models_dir(), model_id))
+
+
 def _get_model_metadata_path(model_id: str) -> Path:
     models_dir = _get_models_dir()
     metadata_path = os.path.join(models_dir, f"{model_id}.json")
@@ -90,6 +238,25 @@ def _get_models_dir() -> Path:
     return models_dir
 
 
+def _new_version() -> str:
+    # A timestamp keeps versions sorted by date, the random suffix
+    # avoids collisions between concurrent saves
+    return f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+
+
+def _write_file_durably(path: Path, content: str) -> None:
+    """Writes a file and makes sure its content is on disk before we rename it"""
+    with open(path, "w") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _fsync_path(path: Path) -> None:
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
 def _list_pickle_files(path: Path) -> list[str]:
     """List all files in a directory that end with .pkl"""
     return [f for f in os.listdir(path) if f.endswith(".pkl")]
@@ -0,0 +1,151 @@
+"""
+Keeps models in memory for a serving process (e.g. the API) and
+hot-reloads them when a new version is published.
+
+Requests never wait for a reload: a background thread periodically
+checks the active version of the loaded models (reading the tiny
+"ACTIVE" file of the registry), loads a new version completely on the
+side, and then swaps it in by replacing a single dictionary entry.
+Requests that started before the swap finish with the previous
+version, the next ones use the new one.
+
+Only the first request for a model id loads it synchronously.
+Concurrent first requests for the same model id wait for a single
+load instead of each loading the model ("single flight").
+"""
+
+import logging
+import os
+import random
+import threading
+from dataclasses import dataclass
+
+from sklearn.base import BaseEstimator
+
+from dsba.model_prediction import select_inference_engine
+from dsba.model_registry import (
+    ClassifierMetadata,
+    add_model_saved_listener,
+    get_model_version,
+    load_model_and_metadata,
+)
+
+
+@dataclass(frozen=True)
+class ServedModel:
+    model_id: str
+    version: str
+    model: BaseEstimator
+    metadata: ClassifierMetadata
+
+
+class ModelServingCache:
+    def __init__(self, poll_interval_seconds: float = 5.0):
+        self.poll_interval_seconds = poll_interval_seconds
+        self._models: dict[str, ServedModel] = {}
+        self._load_locks: dict[str, threading.Lock] = {}
+        self._load_locks_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._reload_thread: threading.Thread | None = None
+        # Models published by this process are checked right away
+        # instead of waiting for the next poll
+        self._wake_up_event = threading.Event()
+        add_model_saved_listener(lambda model_id: self._wake_up_event.set())
+
+    def get(self, model_id: str) -> ServedModel:
+        served_model = self._models.get(model_id)
+        if served_model is not None:
+            return served_model
+        with self._get_load_lock(model_id):
+            # Another request may have loaded it while we were waiting for the lock
+            served_model = self._models.get(model_id)
+            if served_model is None:
+                try:
+                    served_model = self._load(model_id)
+                except Exception:
+                    # Otherwise every unknown model id requested would
+                    # keep its lock forever
+                    self._drop_load_lock(model_id)
+                    raise
+                self._models[model_id] = served_model
+            return served_model
+
+    def preload(self, model_ids: list[str]) -> None:
+        for model_id in model_ids:
+            self.get(model_id)
+
+    def loaded_models(self) -> list[ServedModel]:
+        return list(self._models.values())
+
+    def start_background_reload(self) -> None:
+        if self._reload_thread is not None:
+            return
+        self._stop_event.clear()
+        self._reload_thread = threading.Thread(
+            target=self._reload_loop, name="model-reload", daemon=True
+        )
+        self._reload_thread.start()
+
+    def stop_background_reload(self) -> None:
+        self._stop_event.set()
+        self._wake_up_event.set()
+        if self._reload_thread is not None:
+            self._reload_thread.join()
+            self._reload_thread = None
+
+    def reload_changed_models(self) -> None:
+        """Checks the loaded models once, swaps in the ones with a new active version"""
+        for served_model in list(self._models.values()):
+            try:
+                active_version = get_model_version(served_model.model_id)
+                if active_version == served_model.version:
+                    continue
+                new_served_model = self._load(served_model.model_id, active_version)
+            except Exception as e:
+                # We keep serving the version we have, and we will try
+                # again at the next poll
+                logging.error(f"Failed to reload model {served_model.model_id}: {e}")
+                continue
+            self._models[served_model.model_id] = new_served_model
+            logging.info(
+                f"Model {served_model.model_id} reloaded: "
+                f"version {served_model.version} -> {new_served_model.version}"
+            )
+
+    def _reload_loop(self) -> None:
+        while not self._stop_event.is_set():
+            # A bit of jitter so that several worker processes don't
+            # all hit the disk at the same moment
+            timeout = self.poll_interval_seconds * random.uniform(0.8, 1.2)
+            self._wake_up_event.wait(timeout)
+            self._wake_up_event.clear()
+            if not self._stop_event.is_set():
+                self.reload_changed_models()
+
+    def _load(self, model_id: str, version: str | None = None) -> ServedModel:
+        version = version or get_model_version(model_id)
+        model, metadata = load_model_and_metadata(model_id, version)
+        model = select_inference_engine(model, metadata, version)
+        return ServedModel(model_id, version, model, metadata)
+
+    def _get_load_lock(self, model_id: str) -> threading.Lock:
+        with self._load_locks_lock:
+            return self._load_locks.setdefault(model_id, threading.Lock())
+
+    def _drop_load_lock(self, model_id: str) -> None:
+        # Requests already waiting on this lock still hold it and
+        # will retry the load themselves
+        with self._load_locks_lock:
+            self._load_locks.pop(model_id, None)
+
+
+_default_serving_cache: ModelServingCache | None = None
+
+
+def get_model_serving_cache() -> ModelServingCache:
+    """Returns the cache shared by the whole process"""
+    global _default_serving_cache  # noqa: PLW0603  (created on first use)
+    if _default_serving_cache is None:
+        poll_interval_seconds = float(os.getenv("DSBA_MODEL_RELOAD_INTERVAL", "5.0"))
+        _default_serving_cache = ModelServingCache(poll_interval_seconds)
+    return _default_serving_cache
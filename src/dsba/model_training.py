@@ -12,16 +12,30 @@ from datetime import datetime
 from sklearn.base import ClassifierMixin, RegressorMixin
 
 from dsba.model_registry import ClassifierMetadata
-from .preprocessing import split_features_and_target, preprocess_dataframe
+from dsba.monitoring import compute_feature_baseline
+from .preprocessing import (
+    fit_categories,
+    preprocess_dataframe,
+    split_features_and_target,
+)
 
 import mlflow
 from dsba.mlflow_integration import start_run, log_trained_model
 
 def train_simple_classifier(
-    df: pd.DataFrame, target_column: str, model_id: str
+    df: pd.DataFrame,
+    target_column: str,
+    model_id: str,
+    inference_engine: str = "native",
 ) -> tuple[ClassifierMixin, ClassifierMetadata]:
     logging.info("Start training a simple classifier")
-    df = preprocess_dataframe(df)
+    # The baseline describes the raw data, so it must be computed before preprocessing
+    # (which modifies the DataFrame)
+    feature_baseline = compute_feature_baseline(df, target_column)
+    # Stored with the model, so that a category gets the same code
+    # at prediction time whatever the other rows
+    categories = fit_categories(df)
+    df = preprocess_dataframe(df, categories)
     X, y = split_features_and_target(df, target_column)
     model = xgb.XGBClassifier(random_state=42)
     model.fit(X, y)
@@ -35,6 +49,9 @@ def train_simple_classifier(
         hyperparameters={"random_state": 42},
         description="",
         performance_metrics={},
+        feature_baseline=feature_baseline,
+        inference_engine=inference_engine,
+        categories=categories,
     )
     return model, metadata
 
@@ -0,0 +1,449 @@
+"""
+Monitoring of the data seen by a served model, to detect when it
+drifts away from the training data.
+
+At training time, we store a summary of each feature (the
+"baseline") in the model metadata:
+- for numeric features, the bin edges of a histogram (deciles of
+  the training data) and the fraction of rows in each bin
+- for categorical features, the fraction of rows of the most frequent categories
+
+At prediction time, a FeatureMonitor updates the same histograms
+and category counts with the records it sees.
+Memory stays constant whatever the traffic: a fixed number of bins per numeric feature,
+the baseline categories plus a small bounded counter of new
+categories per categorical feature.
+Under high throughput only a sample of the rows is looked at.
+The sketches are updated by a background thread, the prediction
+path only queues the sampled rows.
+
+Periodically, the monitor compares the observed distributions to the baseline with the
+Population Stability Index (PSI), a common drift score: below 0.1
+is usually considered stable, above 0.25 a significant shift.
+"""
+
+import logging
+import math
+import os
+import queue
+import random
+import threading
+import time
+from typing import Any
+
+import numpy as np
+import pandas as pd
+
+NUMERIC = "numeric"
+CATEGORICAL = "categorical"
+
+
+def compute_feature_baseline(
+    df: pd.DataFrame, target_column: str, bins: int = 10, max_categories: int = 50
+) -> dict[str, Any]:
+    """Summarizes each feature of the raw training data, in a JSON serializable dict"""
+    baseline = {}
+    for column in df.columns:
+        if column == target_column:
+            continue
+        series = df[column]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(
+            series
+        ):
+            baseline[column] = _numeric_baseline(series, bins)
+        else:
+            baseline[column] = _categorical_baseline(series, max_categories)
+    return baseline
+
+
+def _numeric_baseline(series: pd.Series, bins: int) -> dict[str, Any]:
+    values = series.dropna().to_numpy(dtype=np.float64)
+    # Inner edges only: the first and last bins are open ("below the
+    # 1st decile", "above the 9th decile")
+    quantiles = np.linspace(0, 1, bins + 1)[1:-1]
+    edges = np.unique(np.quantile(values, quantiles)) if len(values) else np.array([])
+    counts = np.bincount(
+        np.searchsorted(edges, values, side="right"), minlength=len(edges) + 1
+    )
+    return {
+        "type": NUMERIC,
+        "bin_edges": edges.tolist(),
+        "bin_fractions": (counts / max(len(values), 1)).tolist(),
+        "missing_fraction": float(series.isna().mean()) if len(series) else 0.0,
+    }
+
+
+def _categorical_baseline(series: pd.Series, max_categories: int) -> dict[str, Any]:
+    # Missing values are dropped before converting to strings, otherwise pandas 2
+    # would count them as a "nan" category, which the live sketch never sees
+    fractions = series.dropna().astype(str).value_counts(normalize=True)
+    top_fractions = fractions.head(max_categories)
+    return {
+        "type": CATEGORICAL,
+        "category_fractions": {str(k): float(v) for k, v in top_fractions.items()},
+        "other_fraction": float(1 - top_fractions.sum()),
+        "missing_fraction": float(series.isna().mean()) if len(series) else 0.0,
+    }
+
+
+class _NumericSketch:
+    def __init__(self, baseline: dict[str, Any]):
+        self.edges = np.asarray(baseline["bin_edges"], dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) + 1, dtype=np.int64)
+        self.missing = 0
+
+    def update(self, series: pd.Series) -> None:
+        values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=np.float64)
+        missing = np.isnan(values)
+        self.missing += int(missing.sum())
+        bins = np.searchsorted(self.edges, values[~missing], side="right")
+        self.counts += np.bincount(bins, minlength=len(self.counts))
+
+    def observed_and_expected(self, baseline: dict[str, Any]) -> tuple[list, list]:
+        return self.counts.tolist(), baseline["bin_fractions"]
+
+    def total(self) -> int:
+        return int(self.counts.sum()) + self.missing
+
+    def to_dict(self) -> dict[str, Any]:
+        return {"counts": self.counts.tolist(), "missing": self.missing}
+
+    def merge(self, other: dict[str, Any]) -> None:
+        self.counts += np.asarray(other["counts"], dtype=np.int64)
+        self.missing += other["missing"]
+
+
+class _CategoricalSketch:
+    def __init__(self, baseline: dict[str, Any], max_new_categories: int = 20):
+        self.known_counts = dict.fromkeys(baseline["category_fractions"], 0)
+        self.other = 0
+        self.missing = 0
+        # Misra-Gries counter: it keeps at most max_new_categories entries
+        # and is guaranteed to contain the categories that are
+        # frequent among the new ones
+        self.new_categories: dict[str, int] = {}
+        self.max_new_categories = max_new_categories
+
+    def update(self, series: pd.Series) -> None:
+        self.missing += int(series.isna().sum())
+        for value, count in series.dropna().astype(str).value_counts().items():
+            if value in self.known_counts:
+                self.known_counts[value] += int(count)
+                continue
+            self.other += int(count)
+            self._add_new_category(value, int(count))
+
+    def _add_new_category(self, value: str, count: int) -> None:
+        if (
+            value in self.new_categories
+            or len(self.new_categories) < self.max_new_categories
+        ):
+            self.new_categories[value] = self.new_categories.get(value, 0) + count
+            return
+        decrement = min(count, *self.new_categories.values())
+        self.new_categories = {
+            k: v - decrement for k, v in self.new_categories.items() if v > decrement
+        }
+        if count > decrement:
+            self.new_categories[value] = count - decrement
+
+    def observed_and_expected(self, baseline: dict[str, Any]) -> tuple[list, list]:
+        observed = [*self.known_counts.values(), self.other]
+        expected = [
+            *baseline["category_fractions"].values(),
+            baseline["other_fraction"],
+        ]
+        return observed, expected
+
+    def total(self) -> int:
+        return sum(self.known_counts.values()) + self.other + self.missing
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "known_counts": dict(self.known_counts),
+            "other": self.other,
+            "missing": self.missing,
+            "new_categories": dict(self.new_categories),
+        }
+
+    def merge(self, other: dict[str, Any]) -> None:
+        for value, count in other["known_counts"].items():
+            self.known_counts[value] = self.known_counts.get(value, 0) + count
+        self.other += other["other"]
+        self.missing += other["missing"]
+        # Adding the counters of the other sketch one category at a
+        # time keeps the Misra-Gries guarantee
+        for value, count in other["new_categories"].items():
+            self._add_new_category(value, count)
+
+
+class FeatureMonitor:
+    def __init__(  # noqa: PLR0913, PLR0917  (settings with defaults)
+        self,
+        model_id: str,
+        baseline: dict[str, Any],
+        sample_rate: float = 1.0,
+        max_rows_per_second: float = 1000,
+        check_interval_seconds: float = 60,
+        psi_threshold: float = 0.25,
+    ):
+        self.model_id = model_id
+        self.baseline = baseline
+        self.sample_rate = sample_rate
+        self.max_rows_per_second = max_rows_per_second
+        self.check_interval_seconds = check_interval_seconds
+        self.psi_threshold = psi_threshold
+        self._sketches = self._new_sketches()
+        self._lock = threading.Lock()
+        self._row_budget = max_rows_per_second
+        self._last_budget_refill = time.monotonic()
+        self._last_check = time.monotonic()
+
+    def _new_sketches(self) -> dict[str, _NumericSketch | _CategoricalSketch]:
+        return {
+            column: _NumericSketch(b) if b["type"] == NUMERIC else _CategoricalSketch(b)
+            for column, b in self.baseline.items()
+        }
+
+    def observe(self, df: pd.DataFrame) -> None:
+        """Queues a sample of the rows about to be scored, to update the sketches"""
+        # Most calls stop here, before doing any work, which keeps
+        # the prediction path fast
+        if random.random() < self.sample_rate:
+            step = self._sampling_step(len(df))
+            if step:
+                columns = [column for column in df.columns if column in self._sketches]
+                # A copy, since the caller goes on to preprocess the frame in place
+                _enqueue(self, df.iloc[::step][columns].copy())
+
+    def observe_records(self, records: list[dict]) -> None:
+        # Same sampling decision as observe, the DataFrame is only
+        # built by the background thread
+        if random.random() < self.sample_rate:
+            step = self._sampling_step(len(records))
+            if step:
+                _enqueue(self, records[::step])
+
+    def flush(self) -> None:
+        """Waits until the rows queued so far are in the sketches (e.g. in tests)"""
+        _queue.join()
+
+    def _sampling_step(self, rows: int) -> int:
+        """
+        Every n-th row is looked at, so that we stay within the row budget.
+        0 if the budget is exhausted
+        """
+        granted = self._take_row_budget(rows)
+        return math.ceil(rows / granted) if granted else 0
+
+    def _update(self, sample: pd.DataFrame) -> None:
+        with self._lock:
+            for column, sketch in self._sketches.items():
+                if column in sample.columns:
+                    sketch.update(sample[column])
+            should_check = (
+                time.monotonic() - self._last_check > self.check_interval_seconds
+            )
+            if should_check:
+                self._last_check = time.monotonic()
+        if should_check:
+            self.log_drift()
+
+    def sketches_state(self) -> dict[str, dict[str, Any]]:
+        """Counts of the sketches, JSON serializable, that drift_report can merge"""
+        with self._lock:
+            return {
+                column: sketch.to_dict() for column, sketch in self._sketches.items()
+            }
+
+    def drift_report(
+        self, other_states: list[dict[str, dict[str, Any]]] = ()
+    ) -> dict[str, dict[str, Any]]:
+        """
+        Compares the distributions observed so far with the baseline.
+        other_states are the sketches_state() of monitors of the same model version in
+        other processes (e.g. the other workers of the API), their counts are added
+        to the ones of this monitor.
+        """
+        sketches = self._sketches
+        if other_states:
+            sketches = self._new_sketches()
+            for state in [self.sketches_state(), *other_states]:
+                for column, sketch_state in state.items():
+                    if column in sketches:
+                        sketches[column].merge(sketch_state)
+        report = {}
+        with self._lock:
+            for column, sketch in sketches.items():
+                baseline = self.baseline[column]
+                observed, expected = sketch.observed_and_expected(baseline)
+                total = sketch.total()
+                report[column] = {
+                    "rows": total,
+                    "psi": population_stability_index(observed, expected),
+                    "missing_fraction": sketch.missing / total if total else 0.0,
+                    "baseline_missing_fraction": baseline["missing_fraction"],
+                }
+                if isinstance(sketch, _CategoricalSketch):
+                    report[column]["frequent_new_categories"] = sorted(
+                        sketch.new_categories,
+                        key=sketch.new_categories.get,
+                        reverse=True,
+                    )
+        return report
+
+    def log_drift(self) -> None:
+        for column, feature_report in self.drift_report().items():
+            psi = feature_report["psi"]
+            if psi is not None and psi > self.psi_threshold:
+                logging.warning(
+                    f"Drift detected for model {self.model_id} "
+                    f"on feature {column}: PSI={psi:.3f}"
+                )
+
+    def _take_row_budget(self, rows: int) -> int:
+        with self._lock:
+            now = time.monotonic()
+            self._row_budget = min(
+                self.max_rows_per_second,
+                self._row_budget
+                + (now - self._last_budget_refill) * self.max_rows_per_second,
+            )
+            self._last_budget_refill = now
+            granted = min(rows, int(self._row_budget))
+            self._row_budget -= granted
+            return granted
+
+
+# Samples waiting to be added to the sketches. Updating the sketches takes a
+# few milliseconds per sample, so it is done by a background thread instead of
+# the request. The queue is bounded: when the thread can't keep up, new samples
+# are dropped rather than piling up in memory or slowing down predictions.
+_queue: queue.Queue[tuple[FeatureMonitor, pd.DataFrame | list[dict]]] = queue.Queue(
+    maxsize=int(os.getenv("DSBA_MONITORING_QUEUE_SIZE", "100"))
+)
+_worker_lock = threading.Lock()
+_worker_pid: int | None = None
+dropped_samples = 0
+
+
+def _enqueue(monitor: FeatureMonitor, sample: pd.DataFrame | list[dict]) -> None:
+    global dropped_samples  # noqa: PLW0603  (a counter of the process)
+    _ensure_worker()
+    try:
+        _queue.put_nowait((monitor, sample))
+    except queue.Full:
+        dropped_samples += 1
+
+
+def _ensure_worker() -> None:
+    global _worker_pid  # noqa: PLW0603  (the worker thread is per process)
+    # Threads don't survive a fork: a forked API worker starts its own
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            threading.Thread(
+                target=_update_sketches_forever, name="feature-monitor", daemon=True
+            ).start()
+            _worker_pid = os.getpid()
+
+
+def _update_sketches_forever() -> None:
+    while True:
+        items = [_queue.get()]
+        # Everything already waiting is processed together: one
+        # sketch update per monitor instead of one per sample
+        while True:
+            try:
+                items.append(_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            samples_by_monitor: dict[int, tuple[FeatureMonitor, list]] = {}
+            for monitor, sample in items:
+                _, samples = samples_by_monitor.setdefault(id(monitor), (monitor, []))
+                samples.append(sample)
+            for monitor, samples in samples_by_monitor.values():
+                monitor._update(_concat_samples(samples))
+        except Exception as e:
+            logging.error(f"Failed to update the feature monitors: {e}")
+        finally:
+            for _ in items:
+                _queue.task_done()
+
+
+def _concat_samples(samples: list[pd.DataFrame | list[dict]]) -> pd.DataFrame:
+    frames = [
+        sample if isinstance(sample, pd.DataFrame) else pd.DataFrame(sample)
+        for sample in samples
+    ]
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+
+
+def population_stability_index(
+    observed_counts: list[int], expected_fractions: list[float]
+) -> float | None:
+    total = sum(observed_counts)
+    if total == 0:
+        return None
+    epsilon = 1e-4  # avoids log(0) for empty bins
+    psi = 0.0
+    for count, expected_fraction in zip(
+        observed_counts, expected_fractions, strict=True
+    ):
+        observed = max(count / total, epsilon)
+        expected = max(expected_fraction, epsilon)
+        psi += (observed - expected) * math.log(observed / expected)
+    return psi
+
+
+_monitors: dict[tuple[str, str], FeatureMonitor] = {}
+_monitors_lock = threading.Lock()
+
+
+def get_monitors_state() -> dict[str, dict[str, Any]]:
+    """
+    The sketches of all the monitors of the process, by model id,
+    e.g. to be merged with the ones of other workers
+    """
+    return {
+        model_id: {"version": version, "sketches": monitor.sketches_state()}
+        for (model_id, version), monitor in list(_monitors.items())
+    }
+
+
+def get_feature_monitor(
+    model_id: str, version: str, baseline: dict[str, Any] | None
+) -> FeatureMonitor | None:
+    """
+    Returns the monitor of a model version, shared by the whole process.
+    Returns None if the model has no baseline (models trained before monitoring existed)
+    or if monitoring is disabled (DSBA_MONITORING_SAMPLE_RATE=0).
+    """
+    sample_rate = float(os.getenv("DSBA_MONITORING_SAMPLE_RATE", "0.1"))
+    if not baseline or sample_rate <= 0:
+        return None
+    key = (model_id, version)
+    monitor = _monitors.get(key)
+    if monitor is None:
+        with _monitors_lock:
+            # A new version of the model has its own baseline, the
+            # monitors of the previous versions are dropped
+            for stale_key in [k for k in _monitors if k[0] == model_id and k != key]:
+                del _monitors[stale_key]
+            monitor = _monitors.setdefault(
+                key,
+                FeatureMonitor(
+                    model_id,
+                    baseline,
+                    sample_rate=sample_rate,
+                    max_rows_per_second=float(
+                        os.getenv("DSBA_MONITORING_MAX_ROWS_PER_SECOND", "1000")
+                    ),
+                    check_interval_seconds=float(
+                        os.getenv("DSBA_MONITORING_CHECK_INTERVAL", "60")
+                    ),
+                ),
+            )
+    return monitor
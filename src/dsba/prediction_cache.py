@@ -0,0 +1,179 @@
+"""
+Memoization of predictions: when the same record is scored again with the same model,
+we return the previous prediction instead of building a DataFrame,
+preprocessing it and calling the model again.
+
+Entries are keyed by (model id, model version, hash of the record),
+so a model saved again gets a new version and can never be served stale predictions.
+The cache has a bounded size (least recently used entries are
+evicted first) and entries expire after a TTL.
+
+Note: predictions are cached record by record, so the prediction of a
+record must not depend on the other records scored in the same batch. This
+is only true for models that store their categories in their metadata (see
+preprocessing.fit_categories): the API does not use the cache
+for models saved before that.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+from sklearn.base import ClassifierMixin
+
+from dsba.metrics import REGISTRY, StageTimer
+from dsba.model_prediction import classify_records
+from dsba.model_registry import add_model_saved_listener
+from dsba.monitoring import FeatureMonitor
+
+CACHE_HITS_TOTAL = REGISTRY.counter(
+    "dsba_prediction_cache_hits_total", "Predictions served from the cache"
+)
+CACHE_MISSES_TOTAL = REGISTRY.counter(
+    "dsba_prediction_cache_misses_total", "Predictions not found in the cache"
+)
+
+_MISSING = object()
+
+
+@dataclass
+class PredictionCacheStats:
+    hits: int
+    misses: int
+    evictions: int
+    size: int
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class PredictionCache:
+    def __init__(self, max_entries: int = 100_000, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # An OrderedDict remembers the order of insertion, we move entries to the end
+        # when they are used so the least recently used entry is always the first one.
+        self._entries: OrderedDict[tuple[str, str, str], tuple[float, Any]] = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key: tuple[str, str, str]) -> Any:
+        """Returns the cached prediction, or _MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self._misses += 1
+                return _MISSING
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key: tuple[str, str, str], prediction: Any) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds
+        with self._lock:
+            self._entries[key] = (expires_at, prediction)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate_model(self, model_id: str) -> None:
+        with self._lock:
+            stale_keys = [key for key in self._entries if key[0] == model_id]
+            for key in stale_keys:
+                del self._entries[key]
+
+    def stats(self) -> PredictionCacheStats:
+        with self._lock:
+            return PredictionCacheStats(
+                hits=self._hits,
+                misses=self._misses,
+                evictions=self._evictions,
+                size=len(self._entries),
+            )
+
+
+def classify_records_cached(  # noqa: PLR0913, PLR0917  (classify_records + cache key)
+    cache: PredictionCache,
+    model: ClassifierMixin,
+    model_id: str,
+    model_version: str,
+    records: list[dict],
+    target_column: str,
+    monitor: FeatureMonitor | None = None,
+    timer: StageTimer | None = None,
+    categories: dict[str, list] | None = None,
+) -> list[int | float | str]:
+    """
+    Same as model_prediction.classify_records, but only the records missing
+    from the cache are scored (all together, in a single DataFrame).
+    The monitor, if any, sees all the records, including the ones served from the cache.
+    """
+    timer = timer or StageTimer()
+    if monitor is not None:
+        monitor.observe_records(records)
+    with timer.time("cache_lookup"):
+        keys = [
+            (model_id, model_version, record_hash(record, target_column))
+            for record in records
+        ]
+        predictions = [cache.get(key) for key in keys]
+    missing_indexes = [i for i, p in enumerate(predictions) if p is _MISSING]
+    CACHE_HITS_TOTAL.inc(len(records) - len(missing_indexes))
+    CACHE_MISSES_TOTAL.inc(len(missing_indexes))
+
+    if missing_indexes:
+        missing_records = [records[i] for i in missing_indexes]
+        new_predictions = classify_records(
+            model, missing_records, target_column, timer=timer, categories=categories
+        )
+        for i, prediction in zip(missing_indexes, new_predictions, strict=True):
+            predictions[i] = prediction
+            cache.put(keys[i], prediction)
+    return predictions
+
+
+def record_hash(record: dict, target_column: str) -> str:
+    """
+    Hash of a canonical form of the record: keys sorted, no whitespace,
+    and without the target column since it is dropped before predicting anyway.
+    """
+    canonical_record = {k: v for k, v in record.items() if k != target_column}
+    canonical_json = json.dumps(
+        canonical_record, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.blake2b(canonical_json.encode(), digest_size=16).hexdigest()
+
+
+_default_cache: PredictionCache | None = None
+
+
+def get_prediction_cache() -> PredictionCache | None:
+    """
+    Returns the cache shared by the process, or None if caching is disabled.
+    It is enabled by setting DSBA_PREDICTION_CACHE_SIZE (max number
+    of cached predictions) to a positive value.
+    """
+    global _default_cache  # noqa: PLW0603  (created on first use)
+    max_entries = int(os.getenv("DSBA_PREDICTION_CACHE_SIZE", "0"))
+    if max_entries <= 0:
+        return None
+    if _default_cache is None:
+        ttl_seconds = float(os.getenv("DSBA_PREDICTION_CACHE_TTL_SECONDS", "3600"))
+        _default_cache = PredictionCache(max_entries, ttl_seconds)
+        add_model_saved_listener(_default_cache.invalidate_model)
+    return _default_cache
@@ -1,6 +1,11 @@
+import logging
+from collections.abc import Callable, Iterable
+from typing import Any
+
+import numpy as np
+import pandas as pd
 from pandas import DataFrame, Series
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import LabelEncoder
 
 
 def split_features_and_target(
@@ -22,13 +27,216 @@ def split_dataframe(
     return train_test_split(df, test_size=test_size, random_state=42)
 
 
-def preprocess_dataframe(df):
+class StreamingSplitter:
+    """
+    Splits rows into train and test without needing the whole dataset in memory,
+    so it works on chunks (e.g. pd.read_csv(..., chunksize=...) or a database cursor)
+    as well as on a single DataFrame.
+    Processing a DataFrame at once or chunk by chunk gives exactly the same split.
+
+    Without stratification, each row is assigned on its own, from a
+    hash of its key and of the seed.
+    With a key_column, the same row always ends up in the same
+    partition, whatever the order or the chunking.
+    Without one, the key is the position of the row in the stream (counting the rows
+    of the previous chunks, since the index of chunks read from a file or a cursor
+    usually restarts at 0): the split is the same for the same rows in the same order.
+
+    With stratification, for each class of stratify_column we keep the count of rows
+    seen so far, and send to test the rows that keep the proportion of test rows of
+    that class as close as possible to test_size (starting at a random offset given
+    by the seed). Every class is then split in the right proportion, holding only one
+    counter per class in memory. This assignment depends on the order of the rows,
+    not on a key, so key_column can't be combined with stratify_column.
+    """
+
+    def __init__(
+        self,
+        test_size: float = 0.2,
+        seed: int = 42,
+        key_column: str | None = None,
+        stratify_column: str | None = None,
+    ):
+        if not 0 < test_size < 1:
+            raise ValueError(f"test_size must be between 0 and 1, got {test_size}")
+        if key_column is not None and stratify_column is not None:
+            raise ValueError(
+                "key_column is not used by a stratified split, "
+                "which assigns rows from their order within their class"
+            )
+        self.test_size = test_size
+        self.seed = seed
+        self.key_column = key_column
+        self.stratify_column = stratify_column
+        # Number of rows seen so far, in total and for each class (with stratification)
+        self._rows_seen = 0
+        self._rows_per_class: dict[Any, int] = {}
+
+    def split(self, df: DataFrame) -> tuple[DataFrame, DataFrame]:
+        """Splits one DataFrame, or the next chunk of a stream, into (train, test)"""
+        is_test = self._test_mask(df)
+        return df[~is_test], df[is_test]
+
+    def split_chunks(
+        self,
+        chunks: Iterable[DataFrame],
+        train_sink: Callable[[DataFrame], None],
+        test_sink: Callable[[DataFrame], None],
+    ) -> tuple[int, int]:
+        """
+        Splits a stream of chunks and sends each partition to its own sink
+        (any function taking a DataFrame, for example one appending to a file)
+        as soon as a chunk is processed.
+        Returns the number of train rows and test rows.
+        """
+        train_rows, test_rows = 0, 0
+        for chunk in chunks:
+            train, test = self.split(chunk)
+            train_sink(train)
+            test_sink(test)
+            train_rows += len(train)
+            test_rows += len(test)
+        return train_rows, test_rows
+
+    def _test_mask(self, df: DataFrame) -> np.ndarray:
+        first_row = self._rows_seen
+        self._rows_seen += len(df)
+        if self.stratify_column is None:
+            if self.key_column:
+                keys = df[self.key_column]
+            else:
+                keys = Series(np.arange(first_row, self._rows_seen, dtype=np.int64))
+            return _uniform_hash(keys, self.seed) < self.test_size
+        return self._stratified_test_mask(df[self.stratify_column])
+
+    def _stratified_test_mask(self, classes: Series) -> np.ndarray:
+        # Position of each row among the rows of its class, counting the rows of the
+        # previous chunks
+        position = (
+            classes.groupby(classes, sort=False, dropna=False)
+            .cumcount()
+            .to_numpy(copy=True)
+        )
+        for value, count in classes.value_counts(dropna=False).items():
+            if pd.isna(value):
+                # NaN is not equal to itself, so it can't be used as a dictionary key
+                # across chunks
+                is_class, key = classes.isna().to_numpy(), "__missing__"
+            else:
+                is_class, key = (classes == value).to_numpy(), value
+            position[is_class] += self._rows_per_class.get(key, 0)
+            self._rows_per_class[key] = self._rows_per_class.get(key, 0) + count
+        class_names = classes.astype(str)
+        offset = _uniform_hash(class_names, self.seed)
+        # The k-th row of a class goes to test when the expected number of
+        # test rows, k * test_size, crosses an integer. Over n rows, exactly
+        # floor(n * test_size) (+1 depending on the offset) go to test.
+        return np.floor((position + 1) * self.test_size + offset) > np.floor(
+            position * self.test_size + offset
+        )
+
+
+def _uniform_hash(values: Series, seed: int) -> np.ndarray:
+    """Deterministic pseudo random number in [0, 1) for each value"""
+    hash_key = f"{seed:016d}"[-16:]  # pandas expects a key of 16 characters
+    hashes = pd.util.hash_pandas_object(values, index=False, hash_key=hash_key)
+    return hashes.to_numpy(dtype=np.uint64) / np.float64(2**64)
+
+
+def fit_categories(df: DataFrame) -> dict[str, list]:
+    """
+    Sorted distinct values of each non-numeric column, to store in
+    the model metadata at training time.
+    Given to preprocess_dataframe, they make every value get the
+    same code whatever the other rows of the DataFrame.
+    """
+    categories = {}
+    for column in df.select_dtypes(include=["object", "string", "category"]):
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.categories
+        else:
+            _, values = pd.factorize(series, sort=True)
+        # numpy scalars (e.g. in a column mixing strings and numbers)
+        # are not JSON serializable
+        categories[column] = [v.item() if hasattr(v, "item") else v for v in values]
+    return categories
+
+
+def preprocess_dataframe(
+    df: DataFrame, categories: dict[str, list] | None = None
+) -> DataFrame:
     """
     Preprocess DataFrame by encoding categorical columns.
     ML algorithms typically can't only handle numbers, so there may be quite a lot of feature engineering and preprocessing with other types of data.
     Here, we take a very simplistic approach of applying the same treatment to all non-numeric columns.
+
+    With `categories` (see fit_categories), each value of a column is replaced
+    by its position in the list of the categories of that column seen at
+    training time. Values not seen at training time and missing values get -1.
+    The other non-numeric columns were numeric at training time, they are
+    converted back to numbers (e.g. a JSON record with a null in a numeric
+    field makes an object column), unparsable values becoming missing.
+    Without it (models trained before categories were stored), the
+    codes are computed as these models were trained:
+    from the values of this DataFrame only, so the code of a value
+    depends on the other rows.
+
+    Columns are converted in place to the smallest dtype that holds their values:
+    categories become small integer codes,
+    floats become float32 (which is what XGBoost uses internally
+    anyway) and integers are downcast to their range.
+    On wide datasets this divides the memory used by the frame by 2 or more.
     """
-    for column in df.select_dtypes(include=["object"]):
-        le = LabelEncoder()
-        df[column] = le.fit_transform(df[column].astype(str))
+    memory_before = _memory_usage_for_debug(df)
+    if categories is None:
+        for column in df.select_dtypes(include=["object", "string", "category"]):
+            df[column] = _encode_categories(df[column])
+    else:
+        for column, column_categories in categories.items():
+            if column in df.columns:
+                df[column] = _encode_known_categories(df[column], column_categories)
+        for column in df.select_dtypes(include=["object", "string", "category"]):
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+    for column in df.select_dtypes(include=["floating"]):
+        df[column] = df[column].astype(np.float32)
+    for column in df.select_dtypes(include=["integer"]):
+        df[column] = pd.to_numeric(df[column], downcast="integer")
+    if memory_before is not None:
+        logging.debug(
+            f"Preprocessing memory: {memory_before / 1e6:.1f} MB -> "
+            f"{df.memory_usage(deep=True).sum() / 1e6:.1f} MB"
+        )
     return df
+
+
+def _encode_known_categories(series: Series, categories: list) -> np.ndarray:
+    codes = pd.Index(categories).get_indexer(series)
+    return pd.to_numeric(codes, downcast="integer")
+
+
+def _encode_categories(series: Series) -> np.ndarray:
+    """
+    Encoding used for models saved without their categories. It gives
+    the same codes as the LabelEncoder these models were trained with:
+    values are converted to strings and replaced by their position in
+    the sorted list of the distinct strings of this DataFrame.
+    Missing values become the string "nan" with pandas 2, with pandas 3
+    they stay missing and LabelEncoder gives them the code after the
+    last string.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.to_numpy()
+    else:
+        codes, uniques = pd.factorize(series.astype(str), sort=True)
+        # factorize gives -1 to missing values
+        codes[codes == -1] = len(uniques)
+    return pd.to_numeric(codes, downcast="integer")
+
+
+def _memory_usage_for_debug(df: DataFrame) -> int | None:
+    # Measuring the memory of text columns means visiting every
+    # string, we only do it when it will be logged
+    if not logging.getLogger().isEnabledFor(logging.DEBUG):
+        return None
+    return int(df.memory_usage(deep=True).sum())
@@ -0,0 +1,223 @@
+"""
+On-demand profiling of a piece of code (an API request, a CLI run...).
+
+Two profiles are captured at the same time:
+- a deterministic profile with cProfile, saved as a ".pstats" file
+  (open it with `python -m pstats` or snakeviz)
+- a sampling profile, where a background thread looks at the stack
+  of the profiled thread at a regular interval.
+  It is saved in the "collapsed stacks" format
+  (one line per stack, "frame;frame;frame count"),
+  which is what flamegraph tools (flamegraph.pl, speedscope, inferno...) expect.
+
+Profiling has a cost, so it is opt-in and rate limited: at most
+DSBA_PROFILE_MAX_PER_MINUTE profiles are captured per minute, the
+rest of the requests asking for a profile just run normally.
+"""
+
+import cProfile
+import fcntl
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+
+from dsba.worker_state import get_worker_state_dir
+
+
+@dataclass
+class ProfilingConfig:
+    # The environment is read when a config is created, not at import time
+    output_dir: str = field(
+        default_factory=lambda: os.getenv("DSBA_PROFILE_DIR", "profiles")
+    )
+    max_profiles_per_minute: int = field(
+        default_factory=lambda: int(os.getenv("DSBA_PROFILE_MAX_PER_MINUTE", "6"))
+    )
+    sampling_interval_seconds: float = field(
+        default_factory=lambda: float(
+            os.getenv("DSBA_PROFILE_SAMPLING_INTERVAL", "0.001")
+        )
+    )
+    # File holding the rate limit shared by several processes,
+    # None for a limit per process
+    rate_limit_state_path: str | None = None
+
+
+@dataclass
+class ProfileResult:
+    pstats_path: Path
+    collapsed_stacks_path: Path
+
+
+class RateLimiter:
+    """
+    Token bucket: it holds at most `max_per_minute` tokens and refills continuously.
+    Each profile consumes one token, when the bucket is empty
+    profiling requests are refused.
+
+    With a state_path, the bucket is kept in that file (locked while
+    it is updated) instead of in memory, so that several processes
+    (e.g. the workers of the API) share the same limit.
+    """
+
+    def __init__(self, max_per_minute: int, state_path: str | Path | None = None):
+        self.capacity = max(max_per_minute, 0)
+        self.state_path = Path(state_path) if state_path is not None else None
+        self._tokens = float(self.capacity)
+        self._refill_per_second = self.capacity / 60
+        self._last_refill = time.time()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.state_path is None:
+                return self._take_token()
+            with open(self.state_path, "a+") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                content = f.read()
+                if content:
+                    self._tokens, self._last_refill = json.loads(content)
+                else:
+                    self._tokens, self._last_refill = float(self.capacity), time.time()
+                acquired = self._take_token()
+                f.seek(0)
+                f.truncate()
+                json.dump([self._tokens, self._last_refill], f)
+                return acquired
+
+    def _take_token(self) -> bool:
+        # Wall clock time, since the refill time may be shared with other processes
+        now = time.time()
+        self._tokens = min(
+            self.capacity,
+            self._tokens + max(now - self._last_refill, 0) * self._refill_per_second,
+        )
+        self._last_refill = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+class Profiler:
+    def __init__(self, config: ProfilingConfig | None = None):
+        self.config = config or ProfilingConfig()
+        self._rate_limiter = RateLimiter(
+            self.config.max_profiles_per_minute, self.config.rate_limit_state_path
+        )
+        # cProfile relies on a process wide hook, two profiles can't
+        # be captured at the same time
+        self._profile_lock = threading.Lock()
+
+    @contextmanager
+    def profile(self, name: str) -> Iterator[ProfileResult | None]:
+        """
+        Profiles the code run inside the "with" block, if the rate limit allows it.
+        It yields the paths where the profile will be written, or
+        None if this block is not profiled.
+        """
+        # The lock is taken first, so that a request which can't be profiled
+        # anyway doesn't use up a token of the rate limit
+        if not self._profile_lock.acquire(blocking=False):
+            logging.info(f"Profiling of '{name}' skipped (another profile is running)")
+            yield None
+            return
+        if not self._rate_limiter.try_acquire():
+            self._profile_lock.release()
+            logging.info(f"Profiling of '{name}' skipped (rate limited)")
+            yield None
+            return
+        try:
+            result = self._result_paths(name)
+            sampler = _StackSampler(
+                threading.get_ident(), self.config.sampling_interval_seconds
+            )
+            profiler = cProfile.Profile()
+            sampler.start()
+            profiler.enable()
+            try:
+                yield result
+            finally:
+                profiler.disable()
+                sampler.stop()
+                profiler.dump_stats(result.pstats_path)
+                sampler.write_collapsed_stacks(result.collapsed_stacks_path)
+                logging.info(f"Profile of '{name}' written to {result.pstats_path}")
+        finally:
+            self._profile_lock.release()
+
+    def _result_paths(self, name: str) -> ProfileResult:
+        output_dir = Path(self.config.output_dir).expanduser().resolve()
+        output_dir.mkdir(parents=True, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        safe_name = "".join(c if c.isalnum() or c in "-_" else "_" for c in name)
+        base = output_dir / f"{timestamp}_{safe_name}"
+        return ProfileResult(
+            pstats_path=base.with_suffix(".pstats"),
+            collapsed_stacks_path=base.with_suffix(".folded"),
+        )
+
+
+@dataclass
+class _StackSampler:
+    thread_id: int
+    interval_seconds: float
+    stacks: Counter = field(default_factory=Counter)
+
+    def __post_init__(self):
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                return
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                location = f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}"
+                stack.append(f"{code.co_name} ({location})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def write_collapsed_stacks(self, path: Path) -> None:
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+
+_default_profiler: Profiler | None = None
+
+
+def get_profiler() -> Profiler:
+    """
+    Returns the profiler shared by the whole process, so the rate limit applies globally
+    """
+    global _default_profiler  # noqa: PLW0603  (created on first use)
+    if _default_profiler is None:
+        config = ProfilingConfig()
+        # The workers of the API share their rate limit, otherwise it
+        # would be multiplied by the number of workers
+        state_dir = get_worker_state_dir()
+        if state_dir is not None:
+            config.rate_limit_state_path = str(state_dir / "profiling_rate_limit.lock")
+        _default_profiler = Profiler(config)
+    return _default_profiler
@@ -0,0 +1,125 @@
+"""
+Shadow scoring: candidate ("shadow") models score the same requests
+as the production ("primary") model, but their predictions are only
+logged and compared, never returned to the client.
+
+Shadow predictions run in background threads after the primary predictions are computed,
+so they don't add latency to the response. If the shadow models can't keep up,
+new shadow work is dropped instead of piling up in memory.
+"""
+
+import logging
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from dsba.metrics import REGISTRY
+from dsba.model_prediction import classify_dataframe_multi
+from dsba.model_serving import ServedModel
+
+SHADOW_PREDICTIONS_TOTAL = REGISTRY.counter(
+    "dsba_shadow_predictions_total",
+    "Predictions made by shadow models",
+    ("model_id", "primary_model_id"),
+)
+SHADOW_AGREEMENTS_TOTAL = REGISTRY.counter(
+    "dsba_shadow_agreements_total",
+    "Shadow predictions equal to the prediction of the primary model",
+    ("model_id", "primary_model_id"),
+)
+SHADOW_DROPPED_TOTAL = REGISTRY.counter(
+    "dsba_shadow_dropped_total",
+    "Shadow scoring requests dropped because too many were pending",
+)
+
+
+class ShadowScorer:
+    def __init__(self, max_workers: int = 2, max_pending: int = 100):
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="shadow"
+        )
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def submit(
+        self,
+        get_model: Callable[[str], ServedModel],
+        shadow_model_ids: list[str],
+        df: pd.DataFrame,
+        primary_model_id: str,
+        primary_predictions: list,
+    ) -> bool:
+        """
+        Schedules the scoring of the raw records of df by the shadow models
+        (they are preprocessed in the background, with the categories
+        of each shadow model).
+        The DataFrame must not be modified afterwards, pass a copy if needed.
+        Models are fetched with get_model in the background too, so a
+        shadow model that is not loaded yet does not slow down the
+        request. Returns False if the work was dropped.
+        """
+        if not shadow_model_ids:
+            return True
+        if not self._pending.acquire(blocking=False):
+            SHADOW_DROPPED_TOTAL.inc()
+            return False
+        self._executor.submit(
+            self._score,
+            get_model,
+            shadow_model_ids,
+            df,
+            primary_model_id,
+            primary_predictions,
+        )
+        return True
+
+    def _score(
+        self,
+        get_model: Callable[[str], ServedModel],
+        shadow_model_ids: list[str],
+        df: pd.DataFrame,
+        primary_model_id: str,
+        primary_predictions: list,
+    ) -> None:
+        try:
+            served_models = [get_model(model_id) for model_id in shadow_model_ids]
+            all_predictions = classify_dataframe_multi(
+                {m.model_id: m.model for m in served_models},
+                df,
+                [m.metadata.target_column for m in served_models],
+                categories={m.model_id: m.metadata.categories for m in served_models},
+            )
+            for model_id, predictions in all_predictions.items():
+                agreements = sum(
+                    p == primary
+                    for p, primary in zip(predictions, primary_predictions, strict=True)
+                )
+                SHADOW_PREDICTIONS_TOTAL.inc(
+                    len(predictions),
+                    model_id=model_id,
+                    primary_model_id=primary_model_id,
+                )
+                SHADOW_AGREEMENTS_TOTAL.inc(
+                    agreements, model_id=model_id, primary_model_id=primary_model_id
+                )
+                logging.info(
+                    f"Shadow model {model_id} agrees with {primary_model_id} "
+                    f"on {agreements}/{len(predictions)} records"
+                )
+        except Exception as e:
+            # A broken shadow model must never affect the service
+            logging.error(f"Shadow scoring with {shadow_model_ids} failed: {e}")
+        finally:
+            self._pending.release()
+
+
+_default_shadow_scorer: ShadowScorer | None = None
+
+
+def get_shadow_scorer() -> ShadowScorer:
+    """Returns the shadow scorer shared by the whole process"""
+    global _default_shadow_scorer  # noqa: PLW0603  (created on first use)
+    if _default_shadow_scorer is None:
+        _default_shadow_scorer = ShadowScorer()
+    return _default_shadow_scorer
@@ -0,0 +1,319 @@
+"""
+A compiled inference engine for XGBoost tree ensembles.
+
+For the small inputs of an API request, most of the time of
+XGBoost's predict goes into per-call overhead (validating the
+DataFrame, building a DMatrix...), not into walking the trees.
+Here the trees of a trained model are "compiled" once into flat numpy arrays,
+one entry per node: feature index, threshold, left child, right child,
+child to follow when the value is missing, leaf value.
+
+To predict, all the rows of a batch walk all the trees at the same time: at each
+step, a vectorized numpy operation moves every (row, tree) pair one level down,
+so the number of Python steps is the depth of the trees, not the number of nodes.
+Leaves point to themselves, so pairs that reach a leaf early simply stay there.
+
+Only the "gbtree" booster with numerical splits and the binary:logistic,
+binary:logitraw, multi:softprob and multi:softmax objectives are supported.
+Predictions match XGBoost up to float rounding of the sum of the leaf values.
+"""
+
+import json
+import logging
+import math
+import os
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SUPPORTED_OBJECTIVES = (
+    "binary:logistic",
+    "binary:logitraw",
+    "multi:softprob",
+    "multi:softmax",
+)
+COMPILED_MODEL_FILE = "compiled_trees.npz"
+
+# Rows are processed by blocks so the (rows x trees) working arrays stay small
+_ROWS_PER_BLOCK = 4096
+
+
+# Compared by identity, comparing the arrays of two models would be costly
+@dataclass(eq=False)
+class CompiledTreeEnsemble:
+    # One entry per node, of all the trees
+    feature_index: np.ndarray
+    threshold: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    missing: np.ndarray
+    leaf_value: np.ndarray
+    # One entry per tree: its root node and the class its leaves add up to
+    roots: np.ndarray
+    tree_class: np.ndarray
+    max_depth: int
+    base_margin: np.ndarray
+    n_classes: int
+    objective: str
+    feature_names: list[str] | None
+    # Named as in scikit-learn
+    classes_: np.ndarray | None = None
+
+    def __post_init__(self):
+        if self.classes_ is None:
+            self.classes_ = np.arange(max(self.n_classes, 2))
+
+    # The X arguments follow the scikit-learn API of the model this replaces
+    def predict_margin(self, X: pd.DataFrame | np.ndarray) -> np.ndarray:  # noqa: N803
+        """
+        Raw scores before the sigmoid / softmax, of shape (rows, 1)
+        for binary models, (rows, classes) otherwise
+        """
+        values = self._to_array(X)
+        n_outputs = self.n_classes if self.objective.startswith("multi:") else 1
+        margins = np.empty((len(values), n_outputs), dtype=np.float64)
+        for start in range(0, len(values), _ROWS_PER_BLOCK):
+            block = values[start : start + _ROWS_PER_BLOCK]
+            leaves = self._leaf_values(block)
+            for k in range(n_outputs):
+                margins[start : start + len(block), k] = leaves[
+                    :, self.tree_class == k
+                ].sum(axis=1, dtype=np.float64)
+        return margins + self.base_margin
+
+    def predict_proba(self, X: pd.DataFrame | np.ndarray) -> np.ndarray:  # noqa: N803
+        margins = self.predict_margin(X)
+        if margins.shape[1] == 1:
+            positive = 1 / (1 + np.exp(-margins[:, 0]))
+            return np.column_stack([1 - positive, positive])
+        exp = np.exp(margins - margins.max(axis=1, keepdims=True))
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, X: pd.DataFrame | np.ndarray) -> np.ndarray:  # noqa: N803
+        margins = self.predict_margin(X)
+        if margins.shape[1] == 1:
+            # Same as a probability above 0.5, without computing the sigmoid
+            class_index = (margins[:, 0] > 0).astype(np.int64)
+        else:
+            class_index = margins.argmax(axis=1)
+        return self.classes_[class_index]
+
+    def _leaf_values(self, values: np.ndarray) -> np.ndarray:
+        n_rows = len(values)
+        rows = np.arange(n_rows)[:, None]
+        nodes = np.broadcast_to(self.roots, (n_rows, len(self.roots))).copy()
+        for _ in range(self.max_depth):
+            features = self.feature_index[nodes]
+            # Leaves have feature -1, they read column 0 but the
+            # result is ignored since their children are themselves
+            x = values[rows, np.maximum(features, 0)]
+            nodes = np.where(
+                np.isnan(x),
+                self.missing[nodes],
+                np.where(
+                    x < self.threshold[nodes], self.left[nodes], self.right[nodes]
+                ),
+            )
+        return self.leaf_value[nodes]
+
+    def _to_array(self, features: pd.DataFrame | np.ndarray) -> np.ndarray:
+        if isinstance(features, pd.DataFrame):
+            if self.feature_names is not None:
+                features = features[self.feature_names]
+            features = features.to_numpy(dtype=np.float32, na_value=np.nan)
+        # XGBoost compares float32 values with float32 thresholds, we
+        # do the same to take the same branches
+        return np.asarray(features, dtype=np.float32)
+
+    def save(self, path: str | Path) -> None:
+        """
+        Writes the compiled model to a temporary file renamed at the
+        end, so readers never see a partial file
+        """
+        path = Path(path)
+        tmp_path = path.with_name(f".{path.name}.tmp-{uuid.uuid4().hex}")
+        try:
+            self._write(tmp_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        os.replace(tmp_path, path)
+
+    def _write(self, path: Path) -> None:
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                feature_index=self.feature_index,
+                threshold=self.threshold,
+                left=self.left,
+                right=self.right,
+                missing=self.missing,
+                leaf_value=self.leaf_value,
+                roots=self.roots,
+                tree_class=self.tree_class,
+                base_margin=self.base_margin,
+                classes=self.classes_,
+                header=np.array(
+                    json.dumps(
+                        {
+                            "max_depth": self.max_depth,
+                            "n_classes": self.n_classes,
+                            "objective": self.objective,
+                            "feature_names": self.feature_names,
+                        }
+                    )
+                ),
+            )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "CompiledTreeEnsemble":
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data["header"]))
+            return cls(
+                feature_index=data["feature_index"],
+                threshold=data["threshold"],
+                left=data["left"],
+                right=data["right"],
+                missing=data["missing"],
+                leaf_value=data["leaf_value"],
+                roots=data["roots"],
+                tree_class=data["tree_class"],
+                base_margin=data["base_margin"],
+                classes_=data["classes"],
+                **header,
+            )
+
+
+def compile_xgboost_model(model) -> CompiledTreeEnsemble:
+    """Compiles a trained XGBClassifier (or Booster) into a CompiledTreeEnsemble"""
+    booster = model.get_booster() if hasattr(model, "get_booster") else model
+    learner = json.loads(booster.save_raw(raw_format="json"))["learner"]
+    objective = learner["objective"]["name"]
+    if objective not in SUPPORTED_OBJECTIVES:
+        raise ValueError(
+            f"Objective {objective} is not supported by the compiled engine"
+        )
+    gradient_booster = learner["gradient_booster"]
+    booster_name = gradient_booster["name"]
+    if booster_name != "gbtree":
+        raise ValueError(
+            f"Booster {booster_name} is not supported by the compiled engine"
+        )
+
+    trees = gradient_booster["model"]["trees"]
+    tree_info = gradient_booster["model"]["tree_info"]
+    n_trees = _n_trees_used(model, learner, len(trees))
+    trees, tree_info = trees[:n_trees], tree_info[:n_trees]
+
+    feature_index, threshold, left, right, missing, leaf_value, roots = (
+        [] for _ in range(7)
+    )
+    max_depth = 0
+    offset = 0
+    for tree in trees:
+        if any(split_type != 0 for split_type in tree.get("split_type", [])):
+            raise ValueError(
+                "Categorical splits are not supported by the compiled engine"
+            )
+        tree_left = np.asarray(tree["left_children"], dtype=np.int32)
+        tree_right = np.asarray(tree["right_children"], dtype=np.int32)
+        default_left = np.asarray(tree["default_left"], dtype=bool)
+        conditions = np.asarray(tree["split_conditions"], dtype=np.float32)
+        is_leaf = tree_left == -1
+        node_ids = np.arange(len(tree_left), dtype=np.int32)
+        # Leaves point to themselves so that extra traversal steps
+        # keep them where they are
+        tree_left = np.where(is_leaf, node_ids, tree_left)
+        tree_right = np.where(is_leaf, node_ids, tree_right)
+        feature_index.append(
+            np.where(is_leaf, -1, tree["split_indices"]).astype(np.int32)
+        )
+        threshold.append(conditions)
+        left.append(tree_left + offset)
+        right.append(tree_right + offset)
+        missing.append(np.where(default_left, tree_left, tree_right) + offset)
+        # For leaves, XGBoost stores the leaf value in split_conditions
+        leaf_value.append(np.where(is_leaf, conditions, 0).astype(np.float32))
+        roots.append(offset)
+        max_depth = max(max_depth, _tree_depth(tree_left, tree_right, is_leaf))
+        offset += len(tree_left)
+
+    n_classes = int(learner["learner_model_param"].get("num_class", "0") or 0)
+    feature_names = learner.get("feature_names") or None
+    return CompiledTreeEnsemble(
+        feature_index=np.concatenate(feature_index),
+        threshold=np.concatenate(threshold),
+        left=np.concatenate(left),
+        right=np.concatenate(right),
+        missing=np.concatenate(missing),
+        leaf_value=np.concatenate(leaf_value),
+        roots=np.asarray(roots, dtype=np.int32),
+        tree_class=np.asarray(tree_info, dtype=np.int32),
+        max_depth=max_depth,
+        base_margin=_base_margin(learner, objective),
+        n_classes=n_classes,
+        objective=objective,
+        feature_names=feature_names,
+        classes_=getattr(model, "classes_", None),
+    )
+
+
+def load_or_compile(model, version_dir: Path | None) -> CompiledTreeEnsemble:
+    """
+    Returns the compiled form of a model, cached as a file in the
+    directory of its version in the registry.
+    Versions are immutable, so the cached file never needs to be invalidated.
+    If the cache can't be written (read-only registry, full
+    disk...), the model compiled in memory is still used.
+    """
+    if version_dir is None:
+        return compile_xgboost_model(model)
+    compiled_path = version_dir / COMPILED_MODEL_FILE
+    if compiled_path.exists():
+        return CompiledTreeEnsemble.load(compiled_path)
+    compiled = compile_xgboost_model(model)
+    try:
+        compiled.save(compiled_path)
+    except OSError as e:
+        logging.warning(f"Compiled model not cached in {compiled_path}: {e}")
+    return compiled
+
+
+def _tree_depth(left: np.ndarray, right: np.ndarray, is_leaf: np.ndarray) -> int:
+    """Depth of a tree, computed level by level from the root"""
+    depth = 0
+    level = np.array([0])
+    while not is_leaf[level].all():
+        inner = level[~is_leaf[level]]
+        level = np.concatenate([left[inner], right[inner]])
+        depth += 1
+    return depth
+
+
+def _n_trees_used(model, learner: dict, n_trees: int) -> int:
+    """
+    With early stopping, XGBClassifier.predict only uses the trees
+    up to the best iteration
+    """
+    try:
+        best_iteration = model.best_iteration
+    except AttributeError:
+        return n_trees
+    model_param = learner["gradient_booster"]["model"]["gbtree_model_param"]
+    trees_per_iteration = int(model_param.get("num_parallel_tree", "1")) * max(
+        int(learner["learner_model_param"].get("num_class", "0") or 0), 1
+    )
+    return min(n_trees, (best_iteration + 1) * trees_per_iteration)
+
+
+def _base_margin(learner: dict, objective: str) -> np.ndarray:
+    # Depending on the XGBoost version, base_score is "5E-1" or "[5E-1]"
+    raw_base_score = learner["learner_model_param"]["base_score"].strip("[]")
+    base_scores = [float(value) for value in raw_base_score.split(",")]
+    if objective.startswith("binary:"):
+        # base_score is a probability, the trees add up margins (log odds)
+        base_scores = [math.log(p / (1 - p)) for p in base_scores]
+    return np.asarray(base_scores, dtype=np.float64)
@@ -0,0 +1,116 @@
+"""
+State shared between the worker processes of the API (see src/api/serve.py).
+
+Each worker has its own metrics, prediction cache and drift monitors, in its own memory.
+A request is answered by one worker only, so without this module /metrics,
+/predict/cache/ and /monitoring would each describe a random fraction of
+the traffic, and their values would jump from one scrape to the next.
+
+When DSBA_WORKER_STATE_DIR is set, each worker writes a snapshot of its
+state to <DSBA_WORKER_STATE_DIR>/<pid>.json every
+DSBA_WORKER_STATE_INTERVAL seconds (1 by default), replaced atomically.
+The worker answering a request adds the snapshots of the other
+workers to its own live state.
+The supervisor deletes the snapshot of a worker when it exits, so the totals only
+cover running workers (Prometheus sees the counters of a restarted worker as a counter
+reset, which it handles).
+"""
+
+import json
+import logging
+import os
+import threading
+import uuid
+from dataclasses import asdict
+from pathlib import Path
+from typing import Any
+
+from dsba.metrics import REGISTRY
+from dsba.monitoring import get_monitors_state
+from dsba.prediction_cache import get_prediction_cache
+
+
+def get_worker_state_dir() -> Path | None:
+    """Where the workers share their state, None when the API runs in one process"""
+    state_dir = os.getenv("DSBA_WORKER_STATE_DIR")
+    return Path(state_dir) if state_dir else None
+
+
+def get_state_path(pid: int) -> Path | None:
+    state_dir = get_worker_state_dir()
+    return None if state_dir is None else state_dir / f"{pid}.json"
+
+
+def collect_state() -> dict[str, Any]:
+    """The state of this process, in a JSON serializable form"""
+    cache = get_prediction_cache()
+    return {
+        "pid": os.getpid(),
+        "metrics": REGISTRY.snapshot(),
+        "prediction_cache": None if cache is None else asdict(cache.stats()),
+        "monitors": get_monitors_state(),
+    }
+
+
+def publish_state() -> None:
+    state_path = get_state_path(os.getpid())
+    if state_path is None:
+        return
+    tmp_path = state_path.with_name(f".{state_path.name}.tmp-{uuid.uuid4().hex}")
+    tmp_path.write_text(json.dumps(collect_state()))
+    os.replace(tmp_path, state_path)
+
+
+def read_other_workers_states() -> list[dict[str, Any]]:
+    """The last snapshots of the other workers, empty with a single process"""
+    state_dir = get_worker_state_dir()
+    if state_dir is None:
+        return []
+    states = []
+    for path in state_dir.glob("*.json"):
+        if path.name == f"{os.getpid()}.json":
+            continue
+        try:
+            states.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            # The worker exited and its snapshot was deleted while we
+            # were listing the directory
+            continue
+    return states
+
+
+class StatePublisher:
+    """Background thread publishing the state of the process at a regular interval"""
+
+    def __init__(self, interval_seconds: float | None = None):
+        if interval_seconds is None:
+            interval_seconds = float(os.getenv("DSBA_WORKER_STATE_INTERVAL", "1.0"))
+        self.interval_seconds = interval_seconds
+        self._stop_event = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        if self._thread is not None or get_worker_state_dir() is None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="worker-state", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                publish_state()
+            except Exception as e:
+                logging.error(
+                    f"Failed to publish the state of worker {os.getpid()}: {e}"
+                )
+            if self._stop_event.wait(self.interval_seconds):
+                return
@@ -0,0 +1,69 @@
+from http import HTTPStatus
+
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+from sklearn.dummy import DummyClassifier
+
+from api import api
+from dsba.arrow_format import (
+    ARROW_STREAM_MEDIA_TYPE,
+    read_dataframe_from_bytes,
+    write_dataframe_to_bytes,
+)
+from dsba.model_registry import ClassifierMetadata, save_model
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv("DSBA_MODELS_ROOT_PATH", str(tmp_path))
+    monkeypatch.setenv("DSBA_JOB_WORKERS", "0")
+    model = DummyClassifier(strategy="constant", constant=1).fit([[0], [1]], [0, 1])
+    save_model(
+        model,
+        ClassifierMetadata(
+            id="model",
+            created_at="2024-01-01T00:00:00",
+            algorithm="dummy",
+            hyperparameters={},
+            target_column="target",
+            description="",
+            performance_metrics={},
+            categories={},
+        ),
+    )
+    with TestClient(api.app) as client:
+        yield client
+
+
+def metric_model_ids() -> set[str]:
+    model_id_index = api.PREDICT_REQUESTS_TOTAL.label_names.index("model_id")
+    return {key[model_id_index] for key, _ in api.PREDICT_REQUESTS_TOTAL.snapshot()}
+
+
+def test_unresolved_model_ids_are_not_used_as_metric_labels(client):
+    response = client.get("/predict/?query=not-json&model_id=junk-1")
+    assert response.status_code == HTTPStatus.BAD_REQUEST
+    response = client.get("/predict/?query={}&model_id=junk-2")
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = client.post("/predict/batch/?model_id=junk-3", json=[{"feature": 1}])
+    assert response.status_code == HTTPStatus.NOT_FOUND
+    response = client.post("/predict/batch/?model_id=model", json=[{"feature": 1}])
+    assert response.json() == {"predictions": [1]}
+
+    assert {"junk-1", "junk-2", "junk-3"}.isdisjoint(metric_model_ids())
+    assert {"unknown", "model"} <= metric_model_ids()
+
+
+def test_predict_arrow(client):
+    body = write_dataframe_to_bytes(
+        pd.DataFrame({"feature": [1, 2, 3]}), ARROW_STREAM_MEDIA_TYPE
+    )
+    response = client.post(
+        "/predict/arrow/?model_id=model",
+        content=body,
+        headers={"content-type": ARROW_STREAM_MEDIA_TYPE},
+    )
+    assert response.status_code == HTTPStatus.OK
+    predictions = read_dataframe_from_bytes(response.content, ARROW_STREAM_MEDIA_TYPE)
+    assert predictions["target"].tolist() == [1, 1, 1]
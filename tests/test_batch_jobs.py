@@ -0,0 +1,148 @@
+import pandas as pd
+import pytest
+from sklearn.dummy import DummyClassifier
+
+from dsba import batch_jobs
+from dsba.batch_jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, JobRunner, JobStore
+from dsba.model_registry import ClassifierMetadata, save_model
+
+INPUT_ROWS = 10
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setenv("DSBA_MODELS_ROOT_PATH", str(tmp_path / "models"))
+    model = DummyClassifier(strategy="constant", constant=1).fit([[0], [1]], [0, 1])
+    save_model(
+        model,
+        ClassifierMetadata(
+            id="model",
+            created_at="2024-01-01T00:00:00",
+            algorithm="dummy",
+            hyperparameters={},
+            target_column="target",
+            description="",
+            performance_metrics={},
+        ),
+    )
+    return JobStore(tmp_path / "jobs.sqlite3")
+
+
+@pytest.fixture
+def job(store, tmp_path):
+    input_path = tmp_path / "input.csv"
+    pd.DataFrame({"feature": range(INPUT_ROWS)}).to_csv(input_path, index=False)
+    return store.create(
+        "model", str(input_path), str(tmp_path / "output"), chunk_size=3
+    )
+
+
+def record_written_parts(
+    monkeypatch, stop_runner: JobRunner | None = None
+) -> list[str]:
+    """
+    Records the parts written, and stops the runner after the first
+    one as if its process was killed
+    """
+    written_parts = []
+    write_part = batch_jobs._write_part_atomically
+
+    def write_part_and_record(df, path):
+        write_part(df, path)
+        written_parts.append(path.name)
+        if stop_runner is not None:
+            stop_runner._stop_event.set()
+
+    monkeypatch.setattr(batch_jobs, "_write_part_atomically", write_part_and_record)
+    return written_parts
+
+
+def test_interrupted_job_resumes_after_its_last_chunk(store, job, monkeypatch):
+    first_runner = JobRunner(store)
+    record_written_parts(monkeypatch, stop_runner=first_runner)
+    first_runner._run(store.claim_next(first_runner.owner))
+    interrupted_job = store.get(job.id)
+    assert interrupted_job.status == RUNNING
+    assert interrupted_job.chunks_done == 1
+
+    # The first runner is gone: its lease expires and the job goes back to the queue
+    assert store.requeue_orphaned_jobs(lease_seconds=0) == 1
+    assert store.get(job.id).status == QUEUED
+
+    second_runner = JobRunner(store)
+    written_parts = record_written_parts(monkeypatch)
+    second_runner._run(store.claim_next(second_runner.owner))
+
+    finished_job = store.get(job.id)
+    assert finished_job.status == SUCCEEDED
+    assert finished_job.rows_done == INPUT_ROWS
+    assert written_parts == ["part-00001.csv", "part-00002.csv", "part-00003.csv"]
+    output = pd.concat(
+        pd.read_csv(f"{job.output_dir}/part-{i:05d}.csv") for i in range(4)
+    )
+    assert output["feature"].tolist() == list(range(INPUT_ROWS))
+    assert (output["target"] == 1).all()
+
+
+def test_running_job_with_a_recent_heartbeat_is_not_requeued(store, job):
+    runner = JobRunner(store)
+    store.claim_next(runner.owner)
+    assert store.requeue_orphaned_jobs(lease_seconds=60) == 0
+    assert store.get(job.id).status == RUNNING
+
+
+def test_runner_stops_when_its_lease_was_lost(store, job, monkeypatch):
+    first_runner = JobRunner(store)
+    claimed_job = store.claim_next(first_runner.owner)
+    store.requeue_orphaned_jobs(lease_seconds=0)
+    second_runner = JobRunner(store)
+    store.claim_next(second_runner.owner)
+
+    first_runner._run(claimed_job)
+
+    # The first runner scored one chunk, but its progress was not
+    # recorded over the new owner's
+    reclaimed_job = store.get(job.id)
+    assert reclaimed_job.owner == second_runner.owner
+    assert reclaimed_job.chunks_done == 0
+
+
+def test_failure_of_a_runner_which_lost_its_lease_is_not_recorded(store, job):
+    first_runner = JobRunner(store)
+    store.claim_next(first_runner.owner)
+    store.requeue_orphaned_jobs(lease_seconds=0)
+    second_runner = JobRunner(store)
+    store.claim_next(second_runner.owner)
+
+    assert not store.finish(job.id, first_runner.owner, FAILED, "lost")
+
+    reclaimed_job = store.get(job.id)
+    assert reclaimed_job.status == RUNNING
+    assert reclaimed_job.error is None
+
+
+@pytest.mark.parametrize(
+    ("input_path", "output_dir"),
+    [
+        ("/etc/passwd", "output"),
+        ("../input.csv", "output"),
+        ("input.csv", "/tmp/output"),
+        ("input.csv", "output/../../output"),
+    ],
+)
+def test_job_paths_must_be_in_the_jobs_directory(
+    store, tmp_path, input_path, output_dir
+):
+    (tmp_path / "jobs").mkdir()
+    (tmp_path / "jobs" / "input.csv").write_text("feature\n1\n")
+    jobs_store = JobStore(tmp_path / "jobs" / "jobs.sqlite3")
+
+    with pytest.raises(ValueError, match="not in the jobs directory"):
+        jobs_store.create("model", input_path, output_dir, chunk_size=3)
+
+
+def test_relative_job_paths_are_in_the_jobs_directory(store, tmp_path):
+    job = store.create("model", "input.csv", "output", chunk_size=3)
+
+    assert job.input_path == str(tmp_path / "input.csv")
+    assert job.output_dir == str(tmp_path / "output")
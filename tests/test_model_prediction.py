@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from sklearn.tree import DecisionTreeClassifier
+
+from dsba.model_prediction import (
+    classify_dataframe,
+    classify_record,
+    classify_records,
+)
+from dsba.prediction_cache import PredictionCache, classify_records_cached
+
+CATEGORIES = {"sex": ["female", "male"]}
+
+
+def make_model() -> DecisionTreeClassifier:
+    # Missing ages are predicted 1, known ages 0: a missing value encoded as a
+    # category code instead of NaN would change the prediction
+    features = pd.DataFrame({"sex": [0, 1, 0, 1], "age": [np.nan, np.nan, 20, 30]})
+    return DecisionTreeClassifier(random_state=0).fit(features, [1, 1, 0, 0])
+
+
+def test_record_with_a_null_numeric_field_scores_like_in_a_batch():
+    model = make_model()
+    record = {"sex": "male", "age": None}
+    batch = [record, {"sex": "female", "age": 25.0}]
+
+    batch_predictions = classify_records(
+        model, batch, "survived", categories=CATEGORIES
+    )
+    single_prediction = classify_record(
+        model, record, "survived", categories=CATEGORIES
+    )
+    cached_predictions = classify_records_cached(
+        PredictionCache(),
+        model,
+        "model",
+        "v1",
+        [record],
+        "survived",
+        categories=CATEGORIES,
+    )
+
+    assert batch_predictions == [1, 0]
+    assert single_prediction == batch_predictions[0]
+    assert cached_predictions == batch_predictions[:1]
+
+
+def test_classify_dataframe_returns_the_input_values():
+    df = pd.DataFrame({"sex": ["male", "female"], "age": [7.25, None]})
+
+    scored = classify_dataframe(make_model(), df, "survived", categories=CATEGORIES)
+
+    assert scored["sex"].tolist() == ["male", "female"]
+    assert scored["age"].dtype == np.float64
+    assert scored["age"].iloc[:1].tolist() == [7.25]
+    assert scored["survived"].tolist() == [0, 1]
@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+from sklearn.dummy import DummyClassifier
+
+from dsba import model_registry
+from dsba.model_registry import (
+    ClassifierMetadata,
+    get_model_version,
+    list_model_versions,
+    load_model_and_metadata,
+    save_model,
+)
+from dsba.model_serving import ModelServingCache
+
+
+@pytest.fixture(autouse=True)
+def models_root(tmp_path, monkeypatch):
+    monkeypatch.setenv("DSBA_MODELS_ROOT_PATH", str(tmp_path))
+    return tmp_path
+
+
+def make_model(constant: int) -> DummyClassifier:
+    return DummyClassifier(strategy="constant", constant=constant).fit(
+        [[0], [1]], [0, 1]
+    )
+
+
+def make_metadata(description: str) -> ClassifierMetadata:
+    return ClassifierMetadata(
+        id="model",
+        created_at="2024-01-01T00:00:00",
+        algorithm="dummy",
+        hyperparameters={},
+        target_column="target",
+        description=description,
+        performance_metrics={},
+    )
+
+
+def test_save_model_publishes_a_new_active_version():
+    first_version = save_model(make_model(0), make_metadata("first"))
+    second_version = save_model(make_model(1), make_metadata("second"))
+
+    assert list_model_versions("model") == sorted([first_version, second_version])
+    assert get_model_version("model") == second_version
+    model, metadata = load_model_and_metadata("model")
+    assert model.constant == 1
+    assert metadata.description == "second"
+    # Previous versions stay loadable, e.g. to roll back
+    model, metadata = load_model_and_metadata("model", first_version)
+    assert model.constant == 0
+    assert metadata.description == "first"
+
+
+def test_load_model_and_metadata_never_mixes_versions():
+    save_model(make_model(0), make_metadata("0"))
+    stop = threading.Event()
+
+    def publish():
+        i = 1
+        while not stop.is_set():
+            save_model(make_model(i % 2), make_metadata(str(i % 2)))
+            i += 1
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    try:
+        for _ in range(200):
+            model, metadata = load_model_and_metadata("model")
+            assert str(model.constant) == metadata.description
+    finally:
+        stop.set()
+        publisher.join()
+
+
+def test_failed_save_leaves_nothing_behind(models_root, monkeypatch):
+    version = save_model(make_model(0), make_metadata("first"))
+
+    def failing_dump(*args, **kwargs):
+        raise OSError("No space left on device")
+
+    monkeypatch.setattr(model_registry.joblib, "dump", failing_dump)
+    with pytest.raises(OSError):
+        save_model(make_model(1), make_metadata("second"))
+
+    assert get_model_version("model") == version
+    versions_dir = models_root / "model" / model_registry.VERSIONS_DIR
+    assert [path.name for path in versions_dir.iterdir()] == [version]
+
+
+def test_serving_cache_forgets_the_lock_of_a_failed_load():
+    cache = ModelServingCache()
+    with pytest.raises(FileNotFoundError):
+        cache.get("unknown")
+    assert "unknown" not in cache._load_locks
+
+    save_model(make_model(0), make_metadata("first"))
+    assert cache.get("model").metadata.description == "first"
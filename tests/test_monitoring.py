@@ -0,0 +1,12 @@
+import pandas as pd
+
+from dsba.monitoring import compute_feature_baseline
+
+
+def test_missing_values_are_not_a_category_of_the_baseline():
+    df = pd.DataFrame({"embarked": pd.Series(["S", None, "C", "S"], dtype=object)})
+
+    baseline = compute_feature_baseline(df, "survived")["embarked"]
+
+    assert baseline["category_fractions"] == {"S": 2 / 3, "C": 1 / 3}
+    assert baseline["missing_fraction"] == 1 / 4
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.preprocessing import LabelEncoder
+
+from dsba.preprocessing import preprocess_dataframe
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        ["b", None, "a", "b"],
+        ["b", np.nan, "a", "nan", "zz"],
+        [1, "x", None, 2.5],
+        [None, None],
+    ],
+)
+def test_encoding_without_categories_matches_label_encoder(values):
+    series = pd.Series(values, dtype=object)
+    expected = LabelEncoder().fit_transform(series.astype(str))
+
+    df = preprocess_dataframe(pd.DataFrame({"column": series}))
+
+    assert df["column"].tolist() == expected.tolist()
@@ -0,0 +1,19 @@
+from dsba.profiling import Profiler, ProfilingConfig
+
+MAX_PROFILES_PER_MINUTE = 42
+
+
+def test_config_reads_the_environment_when_created(monkeypatch):
+    monkeypatch.setenv("DSBA_PROFILE_MAX_PER_MINUTE", str(MAX_PROFILES_PER_MINUTE))
+    assert ProfilingConfig().max_profiles_per_minute == MAX_PROFILES_PER_MINUTE
+
+
+def test_busy_profiler_does_not_use_up_the_rate_limit(tmp_path):
+    config = ProfilingConfig(output_dir=str(tmp_path), max_profiles_per_minute=2)
+    profiler = Profiler(config)
+    with profiler.profile("outer") as outer, profiler.profile("inner") as inner:
+        assert outer is not None
+        assert inner is None
+    # Only the outer profile used a token, one is left for the next request
+    with profiler.profile("next") as result:
+        assert result is not None
@@ -0,0 +1,106 @@
+import pandas as pd
+import pytest
+
+from dsba.data_ingestion.query_cache import (
+    QueryResultCache,
+    normalize_sql,
+    referenced_tables,
+)
+
+
+@pytest.mark.parametrize(
+    ("query", "tables"),
+    [
+        ("SELECT * FROM users", {"users"}),
+        (
+            "select * from public.users as u, orders o where u.id = o.user_id",
+            {"users", "orders"},
+        ),
+        (
+            "select * from users u join orders on u.id = orders.user_id",
+            {"users", "orders"},
+        ),
+        ("select * from (select * from events) e", {"events"}),
+        ("select extract(year from ts) from events", {"events"}),
+        ("select substring(name from 2 for 3) from users", {"users"}),
+        (
+            "select coalesce((select max(id) from orders), 0) from users",
+            {"orders", "users"},
+        ),
+        (
+            "select * from users where exists (select 1 from orders)",
+            {"users", "orders"},
+        ),
+        ("select 'from fake' from users", {"users"}),
+        ("select $$ from fake $$ from users", {"users"}),
+        ("select $body$ from fake $body$ from users", {"users"}),
+        ('select * from "Users"', {"Users"}),
+        ("insert into users (id, name) values (1, 'a')", {"users"}),
+        ("update only users set name = 'a' where id = 1", {"users"}),
+        ("delete from users where id = 1", {"users"}),
+        ("truncate users", {"users"}),
+        ("truncate table users, orders", {"users", "orders"}),
+        ("drop table if exists users", {"users"}),
+        ("alter table users add column age int", {"users"}),
+        (
+            "with moved as (delete from events returning *) "
+            "insert into archive select * from moved",
+            {"events", "archive", "moved"},
+        ),
+        ("select 1", None),
+        ("create index users_name on users (name)", None),
+    ],
+)
+def test_referenced_tables(query, tables):
+    assert referenced_tables(normalize_sql(query)) == tables
+
+
+def test_normalization_keeps_quoted_strings():
+    assert normalize_sql("SELECT  *\nFROM users;") == "select * from users"
+    assert normalize_sql("select 'A'") != normalize_sql("select 'a'")
+    assert normalize_sql("select $$A$$") != normalize_sql("select $$a$$")
+    assert normalize_sql("select $t$A$t$") != normalize_sql("select $t$a$t$")
+    assert normalize_sql("SELECT $$A$$") == "select $$A$$"
+
+
+def cache_with(queries: list[str]) -> QueryResultCache:
+    cache = QueryResultCache()
+    for query in queries:
+        cache.put(query, "role", pd.DataFrame({"a": [1]}))
+    return cache
+
+
+@pytest.mark.parametrize(
+    ("write", "invalidated", "kept"),
+    [
+        ("update users set name = 'a'", "select * from users", "select * from orders"),
+        ("truncate users", "select * from users", "select * from orders"),
+        ("drop table users", "select * from users", "select * from orders"),
+        (
+            "with old as (delete from users returning *) insert into archive "
+            "select * from old",
+            "select * from users",
+            "select * from orders",
+        ),
+        (
+            "with new as (select 1) insert into orders select * from new",
+            "select * from orders",
+            "select * from users",
+        ),
+    ],
+)
+def test_writes_invalidate_the_queries_reading_their_tables(write, invalidated, kept):
+    cache = cache_with([invalidated, kept])
+
+    cache.invalidate_query(write)
+
+    assert cache.get(invalidated, "role") is None
+    assert cache.get(kept, "role") is not None
+
+
+def test_write_to_unknown_tables_invalidates_everything():
+    cache = cache_with(["select * from users"])
+
+    cache.invalidate_query("create index users_name on users (name)")
+
+    assert cache.get("select * from users", "role") is None
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+
+from dsba.tree_engine import (
+    COMPILED_MODEL_FILE,
+    CompiledTreeEnsemble,
+    compile_xgboost_model,
+    load_or_compile,
+)
+
+# Missing values, so that the default direction of the splits is used
+MISSING_FRACTION = 0.2
+
+
+def make_dataset(
+    classes: int, rows: int = 2000, seed: int = 0
+) -> tuple[pd.DataFrame, np.ndarray]:
+    rng = np.random.default_rng(seed)
+    values = rng.normal(size=(rows, 8)).astype(np.float32)
+    weights = np.random.default_rng(42).normal(size=(8, classes))
+    y = (values @ weights).argmax(axis=1)
+    values[rng.random(values.shape) < MISSING_FRACTION] = np.nan
+    return pd.DataFrame(values, columns=[f"f{i}" for i in range(8)]), y
+
+
+@pytest.fixture(params=[2, 3], ids=["binary", "multiclass"])
+def trained(request):
+    features, y = make_dataset(request.param)
+    model = xgb.XGBClassifier(n_estimators=20, max_depth=4, random_state=0)
+    model.fit(features, y)
+    test_features, _ = make_dataset(request.param, rows=500, seed=1)
+    return model, test_features
+
+
+def test_compiled_model_matches_xgboost(trained):
+    model, features = trained
+    compiled = compile_xgboost_model(model)
+
+    native_margins = model.predict(features, output_margin=True).reshape(
+        len(features), -1
+    )
+    assert np.allclose(compiled.predict_margin(features), native_margins, atol=1e-5)
+    assert np.allclose(
+        compiled.predict_proba(features), model.predict_proba(features), atol=1e-5
+    )
+    assert np.array_equal(compiled.predict(features), model.predict(features))
+
+
+def test_rows_with_only_missing_values_follow_the_default_directions(trained):
+    model, features = trained
+    features = pd.DataFrame(
+        np.nan, index=range(3), columns=features.columns, dtype=np.float32
+    )
+    compiled = compile_xgboost_model(model)
+
+    native_margins = model.predict(features, output_margin=True).reshape(
+        len(features), -1
+    )
+    assert np.allclose(compiled.predict_margin(features), native_margins, atol=1e-5)
+    assert np.array_equal(compiled.predict(features), model.predict(features))
+
+
+def test_load_or_compile_caches_the_compiled_model(trained, tmp_path):
+    model, features = trained
+    compiled = load_or_compile(model, tmp_path)
+
+    cached = CompiledTreeEnsemble.load(tmp_path / COMPILED_MODEL_FILE)
+    assert np.array_equal(cached.predict(features), compiled.predict(features))
+    assert np.allclose(
+        load_or_compile(model, tmp_path).predict_margin(features),
+        compiled.predict_margin(features),
+    )
+
+
+def test_load_or_compile_works_when_the_cache_cannot_be_written(trained, tmp_path):
+    model, features = trained
+    missing_dir = tmp_path / "missing"
+
+    compiled = load_or_compile(model, missing_dir)
+
+    assert np.array_equal(compiled.predict(features), model.predict(features))
+    assert not missing_dir.exists()